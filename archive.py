@@ -0,0 +1,102 @@
+'''Append-only archive of the pages fetched from the search API.
+
+Pages go to db/archive/NNNNNN.jsonl.gz, one status per line. Each page is
+a separate gzip member, so that a segment can be read whole with gzip.open,
+or a single page can be read by seeking to it. A segment is closed once it
+is larger than max_bytes, and the next one is started. Next to each
+segment, NNNNNN.idx has one INDEX_ENTRY per page: its offset and length in
+the segment, how many statuses it has, and when it was fetched.
+'''
+
+from pathlib import Path
+from time import time
+
+import gzip
+import json
+import struct
+
+ARCHIVE_DIR = Path('db') / 'archive'
+INDEX_ENTRY = struct.Struct('<QQId')
+SEGMENT_BYTES = 64 << 20
+
+def segments():
+  '''Paths of all segments, oldest first.'''
+  return sorted(ARCHIVE_DIR.glob('*.jsonl.gz'))
+
+def index_path(segment):
+  return segment.with_name(segment.name.split('.')[0] + '.idx')
+
+def read_index(segment):
+  '''(offset, length, count, time) of each page of the segment.'''
+  try:
+    data = index_path(segment).read_bytes()
+  except OSError:
+    return []
+  n = len(data) // INDEX_ENTRY.size
+  return [INDEX_ENTRY.unpack_from(data, k * INDEX_ENTRY.size) for k in range(n)]
+
+def read_segment(segment):
+  '''The statuses in the segment, in the order they were fetched.
+
+  Only pages in the index are read, so a page whose write was cut short is
+  skipped.'''
+  with segment.open('rb') as f:
+    for offset, length, _, _ in read_index(segment):
+      f.seek(offset)
+      for line in gzip.decompress(f.read(length)).splitlines():
+        yield json.loads(line)
+
+class Writer:
+  def __init__(self, max_bytes=SEGMENT_BYTES):
+    self.max_bytes = max_bytes
+    self.segment = None
+    self.data = None
+    self.index = None
+    ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+    old = segments()
+    self.number = int(old[-1].name.split('.')[0]) if old else 0
+    if old and old[-1].stat().st_size < max_bytes:
+      self.open(old[-1])
+    else:
+      self.rotate()
+
+  def __enter__(self):
+    return self
+  def __exit__(self, *exc):
+    self.close()
+
+  def open(self, segment):
+    self.segment = segment
+    # Drop whatever an interrupted write left after the last indexed page.
+    pages = read_index(segment)
+    end = pages[-1][0] + pages[-1][1] if pages else 0
+    self.data = segment.open('r+b' if segment.exists() else 'wb')
+    self.data.truncate(end)
+    self.data.seek(end)
+    self.index = index_path(segment).open('ab')
+    self.index.truncate(len(pages) * INDEX_ENTRY.size)
+
+  def rotate(self):
+    self.close()
+    self.number += 1
+    self.open(ARCHIVE_DIR / '{:06}.jsonl.gz'.format(self.number))
+
+  def append(self, statuses):
+    if not statuses:
+      return
+    lines = ''.join(json.dumps(s, separators=(',', ':')) + '\n'
+      for s in statuses)
+    member = gzip.compress(lines.encode())
+    offset = self.data.tell()
+    self.data.write(member)
+    self.data.flush()
+    self.index.write(INDEX_ENTRY.pack(offset, len(member), len(statuses), time()))
+    self.index.flush()
+    if offset + len(member) >= self.max_bytes:
+      self.rotate()
+
+  def close(self):
+    if self.data:
+      self.data.close()
+      self.index.close()
+      self.data = self.index = None
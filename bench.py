@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from pathlib import Path
+from time import localtime, perf_counter, sleep, strftime
+
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import synthetic
+import tempfile
+
+argparser = ArgumentParser(description='''
+  Time each stage of the pipeline on synthetic corpora, and record its
+  peak memory. Every stage runs as a separate process, in a scratch
+  directory, with urls that fake_twitter.py redirects locally. Results go
+  to a JSON file, which -c compares with an earlier one.
+''')
+
+argparser.add_argument('-n', '--sizes', default=[10000], type=int, nargs='+',
+  help='corpus sizes, in tweets; e.g. 10000 1000000 10000000')
+argparser.add_argument('-s', '--stages', nargs='+', choices=[
+    'generate', 'slice', 'normalize_urls', 'rank_users', 'rank_urls',
+    'stats', 'cluster'],
+  help='run only these stages (generate is needed by the others)')
+argparser.add_argument('-o', '--output',
+  help='where to write the results; default bench-DATE.json')
+argparser.add_argument('-c', '--compare',
+  help='an earlier results file, to report the change of each stage')
+argparser.add_argument('-w', '--workdir',
+  help='scratch directory, kept afterwards; default a temporary one')
+
+HERE = Path(__file__).resolve().parent
+
+def free_port():
+  with socket.socket() as s:
+    s.bind(('localhost', 0))
+    return s.getsockname()[1]
+
+def start_redirector():
+  port = free_port()
+  proc = subprocess.Popen([sys.executable, str(HERE / 'fake_twitter.py'),
+    '-p', str(port), '-n', '1'], stderr=subprocess.DEVNULL)
+  for _ in range(100):
+    try:
+      socket.create_connection(('localhost', port)).close()
+      break
+    except OSError:
+      sleep(0.1)
+  return proc, port
+
+def local_time(t):
+  return strftime('%Y%m%d%H%M%S', localtime(t))
+
+def stages(size, port):
+  corpus = synthetic.Corpus(size)
+  start, stop = local_time(corpus.oldest()), local_time(corpus.start + 1)
+  return [
+    ('generate', ['gen_corpus.py', '-n', str(size), '-l',
+      '-u', 'http://localhost:{}/r/2'.format(port)]),
+    ('slice', ['slice.py', start, stop]),
+    ('normalize_urls', ['normalize_urls.py', '-p', '32']),
+    ('rank_users', ['rank_users.py']),
+    ('rank_urls', ['rank_urls.py']),
+    ('stats', ['stats.py', start, stop]),
+    ('cluster', ['cluster.py']),
+  ]
+
+# Runs the script and waits for it with wait4, which also gives the peak
+# resident set size of the process (in KiB on Linux).
+def run(workdir, name, argv):
+  log = (workdir / (name + '.log')).open('w')
+  t = perf_counter()
+  proc = subprocess.Popen([sys.executable, str(HERE / argv[0])] + argv[1:],
+    cwd=str(workdir), stdout=log, stderr=log)
+  _, status, usage = os.wait4(proc.pid, 0)
+  t = perf_counter() - t
+  proc.returncode = os.waitstatus_to_exitcode(status)
+  log.close()
+  return {'seconds': round(t, 3), 'max_rss_kib': usage.ru_maxrss,
+    'user_seconds': round(usage.ru_utime, 3),
+    'system_seconds': round(usage.ru_stime, 3), 'exit': proc.returncode}
+
+def version():
+  try:
+    return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+      cwd=str(HERE), stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def compare(results, path):
+  with open(path) as f:
+    old = {(r['size'], r['stage']): r for r in json.load(f)['results']}
+  for r in results:
+    o = old.get((r['size'], r['stage']))
+    if o and o['seconds'] > 0 and o['max_rss_kib'] > 0:
+      sys.stdout.write('{:>9} {:<15} time {:6.2f}x  memory {:6.2f}x\n'.format(
+        r['size'], r['stage'], r['seconds'] / o['seconds'],
+        r['max_rss_kib'] / o['max_rss_kib']))
+
+def main():
+  args = argparser.parse_args()
+  output = args.output or strftime('bench-%Y%m%d%H%M%S.json')
+  results = []
+  proc, port = start_redirector()
+  try:
+    for size in args.sizes:
+      if args.workdir:
+        workdir = Path(args.workdir) / str(size)
+        shutil.rmtree(str(workdir), ignore_errors=True)
+        workdir.mkdir(parents=True)
+      else:
+        workdir = Path(tempfile.mkdtemp(prefix='twitstat-bench-'))
+      (workdir / 'db').mkdir()
+      shutil.copy(str(HERE / 'stopwords'), str(workdir))
+      failed = False
+      for name, argv in stages(size, port):
+        if args.stages and name not in args.stages and name != 'generate':
+          continue
+        r = run(workdir, name, argv)
+        r.update(size=size, stage=name)
+        results.append(r)
+        failed = failed or r['exit'] != 0
+        sys.stderr.write('{:>9} {:<15} {:8.2f}s {:9} KiB{}\n'.format(size, name,
+          r['seconds'], r['max_rss_kib'],
+          '' if r['exit'] == 0 else '  FAILED, see {}'.format(
+            workdir / (name + '.log'))))
+      if not args.workdir and not failed:
+        shutil.rmtree(str(workdir))
+  finally:
+    proc.terminate()
+    proc.wait()
+  with open(output, 'w') as f:
+    json.dump({'version': version(), 'python': platform.python_version(),
+      'machine': platform.machine(), 'cpus': os.cpu_count(),
+      'date': strftime('%Y-%m-%d %H:%M:%S'), 'results': results}, f, indent=2)
+  sys.stderr.write('results in {}\n'.format(output))
+  if args.compare:
+    compare(results, args.compare)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from array import array
+from time import perf_counter
+
+from pagerank import Graph, have_numpy, solve
+
+import random
+import sys
+
+argparser = ArgumentParser(description='''
+  Time the parallel power method for several numbers of workers, on the
+  graph of db/slice or on a random graph, and print a table on stdout.
+''')
+
+argparser.add_argument('-j', '--workers', default=[1, 2, 4, 8], type=int,
+  nargs='+', help='numbers of worker processes to try')
+argparser.add_argument('-s', '--slice', action='store_true',
+  help='use the user graph of db/slice, as built by rank_users.py')
+argparser.add_argument('-n', '--nodes', default=1000000, type=int,
+  help='nodes of the random graph')
+argparser.add_argument('-d', '--degree', default=10, type=int,
+  help='out-degree of each node of the random graph')
+argparser.add_argument('-e', '--epsilon', default=0.001, type=float,
+  help='error for convergence test')
+argparser.add_argument('-r', '--repeat', default=3, type=int,
+  help='runs per number of workers; the fastest is reported, with its '
+  'speedup over the first number of workers')
+
+# Mentions are skewed, so the targets are drawn with preferential attachment:
+# half of them are copies of earlier targets.
+def random_graph(n, degree):
+  rng = random.Random(0)
+  g = Graph(n, array('q'), array('q'), array('d'))
+  for i in range(n):
+    for _ in range(degree):
+      if g.dst and rng.random() < 0.5:
+        j = g.dst[rng.randrange(len(g.dst))]
+      else:
+        j = rng.randrange(n)
+      g.src.append(i)
+      g.dst.append(j)
+      g.w.append(1 / degree)
+  return g
+
+def slice_graph():
+  import rank_users
+  rank_users.args = rank_users.argparser.parse_args([])
+  return rank_users.build_graph()
+
+def main():
+  args = argparser.parse_args()
+  if not have_numpy():
+    sys.stderr.write('E: the parallel power method needs numpy\n')
+    sys.exit(1)
+  t = perf_counter()
+  g = slice_graph() if args.slice else random_graph(args.nodes, args.degree)
+  sys.stderr.write('graph with {} nodes and {} arcs built in {:.1f}s\n'.format(
+    g.n, len(g.src), perf_counter() - t))
+  base = None
+  sys.stdout.write('workers\titerations\tseconds\tspeedup\n')
+  for workers in args.workers:
+    best = None
+    for _ in range(args.repeat):
+      t = perf_counter()
+      _, iterations = solve(g, tol=args.epsilon, workers=workers)
+      t = perf_counter() - t
+      best = t if best is None else min(best, t)
+    base = base or best
+    sys.stdout.write('{}\t{}\t{:.3f}\t{:.2f}\n'.format(
+      workers, iterations, best, base / best))
+    sys.stdout.flush()
+
+if __name__ == '__main__':
+  main()
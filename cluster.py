@@ -2,17 +2,18 @@
 # vim: set fileencoding=utf-8 :
 
 from collections import deque
-from contextlib import closing
 from heapq import heappop, heappush
 from random import randint
 from re import search
-import shelve
 from sys import argv, exit, stderr, stdin, stdout
 from time import strftime, time
 from urllib.parse import quote
 
 import requests
 
+import histograms
+from pagerank import Graph, have_numpy, solve
+
 # Reading guide:
 #   g   is a graph
 #   dg  is a digraph
@@ -42,43 +43,16 @@ def parse_command():
     stderr.write('The argument should be a number.\n')
     exit(2)
 
-def parse_graph():
-  # Give numbers to names (to speed up the graph algos).
-  all_names = set()
-  with closing(shelve.open('histograms', 'r')) as f:
-    for src in f.keys():
-      all_names.add(src)
-      for tgt in f[src]['mentions'].keys():
-        all_names.add(tgt)
-  index_of_name = dict()
-  name_of_index = ['*ARTIFICIAL*']
-  names_count = 0
-  for n in all_names:
-    if n not in index_of_name:
-      names_count += 1
-      index_of_name[n] = names_count
-      name_of_index.append(n)
-  names_count += 1
-  words_of_user = [dict()]
-  urls_of_user = [dict()]
-  with closing(shelve.open('histograms', 'r')) as f:
-    for n in name_of_index[1:]:
-      if n in f:
-        words_of_user.append(f[n]['words'])
-        urls_of_user.append(f[n]['urls'])
-      else:
-        words_of_user.append(dict())
-        urls_of_user.append(dict())
-
-  # Get the graph, and use numbers to represent it.
-  graph = [dict() for _ in range(names_count)]
-  with closing(shelve.open('histograms', 'r')) as f:
-    for src in f.keys():
-      src_dict = graph[index_of_name[src]]
-      for tgt, w in f[src]['mentions'].items():
-        if tgt != src:
-          src_dict[index_of_name[tgt]] = w
-  return (words_of_user, urls_of_user, name_of_index, graph)
+# Users are numbered as in the histogram store, plus one; 0 is artificial.
+# The histograms of words and urls stay in the store, so words_of_user and
+# urls_of_user are histograms.Table objects, where user x is row x - 1.
+def parse_graph(store):
+  name_of_index = ['*ARTIFICIAL*'] + store.users
+  graph = [dict()]
+  for u in range(len(store.users)):
+    ids, counts = store['mentions'].row(u)
+    graph.append(dict((i + 1, w) for i, w in zip(ids, counts) if i != u))
+  return (store['words'], store['urls'], name_of_index, graph)
 
 def make_undirected(dg, boss, alpha):
   g = dict()
@@ -162,36 +136,33 @@ def pagerank(dg, cluster):
   if len(cluster) > REP_LIMIT:
     stderr.write('ranking {0} users... '.format(len(cluster)))
     t1 = time()
-  g = dict([(x, dict()) for x in cluster])
-  g[0] = dict()
+  # Node 0 is artificial; the others are renumbered 1, 2, ...
+  nodes = [0] + list(cluster)
+  index = dict((x, i) for i, x in enumerate(nodes))
+  g = Graph(len(nodes), [], [], [])
+  def arc(x, y, w):
+    g.src.append(index[x])
+    g.dst.append(index[y])
+    g.w.append(w)
   for x in cluster:
     tw = 1  # for the edge going to 0
     for y, w in dg[x].items():
       if y in cluster:
         tw += w
-    g[0][x] = 1.0 / tw
+    arc(x, 0, 1.0 / tw)
     for y, w in dg[x].items():
       if y in cluster:
-        g[y][x] = 1.0 * w / tw
+        arc(x, y, 1.0 * w / tw)
   for x in cluster:
-    g[x][0] = 1.0 / len(cluster)
+    arc(0, x, 1.0 / len(cluster))
 
-  score = dict.fromkeys(g.keys(), 1.0)
-  new_score = dict.fromkeys(g.keys(), 0.0)
-  for i in range(max(1000, len(cluster))):
-    if len(cluster) > REP_LIMIT:
-      if time() - t1 > 60:
-        stderr.write('stoping early after {0} iterations... '.format(i))
-        break
-    for x, ys in g.items():
-      for y, w in ys.items():
-        new_score[x] += score[y] * w
-    score = new_score
-    new_score = dict.fromkeys(g.keys(), 0.0)
+  engine = 'numpy' if have_numpy() else 'python'
+  score, _ = solve(g, 'gauss-seidel' if engine == 'python' else 'power',
+      engine, tol=1e-9, budget=60)
 
   if len(cluster) > REP_LIMIT:
     stderr.write('done in {0:.2f} seconds\n'.format(time()-t1))
-  return score
+  return dict(zip(nodes, score))
 
 def order_cluster(dg, cluster):
   score = pagerank(dg, cluster)
@@ -219,20 +190,16 @@ def get_cluster(children, level, x):
   return r
 
 def describe_cluster(words_of_user, cluster):
-  interesting_words = set()
+  inside = dict()
   for u in cluster:
-    for w in words_of_user[u].keys():
-      interesting_words.add(w)
-  inside = dict([(w,0) for w in interesting_words])
-  outside = dict([(w,0) for w in interesting_words])
-  for u in range(1, len(words_of_user)):
-    if u in cluster:
-      d = inside
-    else:
-      d = outside
-    for w in interesting_words:
-      if w in words_of_user[u]:
-        d[w] += words_of_user[u][w]
+    ids, counts = words_of_user.row(u - 1)
+    for i, c in zip(ids, counts):
+      inside[i] = inside.get(i, 0) + c
+  total = words_of_user.totals()
+  interesting_words = [words_of_user.terms[i] for i in inside]
+  outside = dict((words_of_user.terms[i], total[i] - c)
+    for i, c in inside.items())
+  inside = dict((words_of_user.terms[i], c) for i, c in inside.items())
   h1 = []
   h2 = []
   for w in interesting_words:
@@ -279,7 +246,8 @@ def print_clusters(words_of_user, name_of_index, orig_graph, children, pl, level
     print_clusters(words_of_user, name_of_index, orig_graph, children, pl + 1, level + 1, x)
 
 def old_main():
-  words_of_user, _, name_of_index, orig_graph = parse_graph()
+  store = histograms.Store()
+  words_of_user, _, name_of_index, orig_graph = parse_graph(store)
   boss = range(len(orig_graph))
   children = []
   for alpha in [0.1, 0.01, 0.005, 0]:
@@ -311,15 +279,10 @@ def get_top(d, cnt):
   return r
 
 def rank_refs(score_of_user, refs_of_user):
-  ref_score = dict()
-  for u in range(1, len(refs_of_user)):
-    refs = refs_of_user[u] 
-    tw = 0.0
-    for w in refs.values():
-      tw += w
-    for r, w in refs.items():
-      ref_score[r] = score_of_user[u] * w / tw + ref_score.setdefault(r, 0.0)
-  return get_top(ref_score, 10)
+  ref_score = refs_of_user.distribute(
+      [score_of_user[u + 1] for u in range(len(refs_of_user))])
+  top = get_top(dict(enumerate(ref_score)), 10)
+  return [refs_of_user.terms[r] for r in top]
 
 def title_of_url(url):
   try:
@@ -347,11 +310,12 @@ def print_words_top(top):
       f.write(s)
 
 def main():
-  words_of_user, urls_of_user, name_of_index, dg = parse_graph()
-  score = pagerank(dg, set(range(1,len(dg))))
-  print_users_top([name_of_index[u] for u in get_top(score, 11)])
-  print_urls_top(rank_refs(score, urls_of_user))
-  print_words_top(rank_refs(score, words_of_user))
+  with histograms.Store() as store:
+    words_of_user, urls_of_user, name_of_index, dg = parse_graph(store)
+    score = pagerank(dg, set(range(1,len(dg))))
+    print_users_top([name_of_index[u] for u in get_top(score, 11)])
+    print_urls_top(rank_refs(score, urls_of_user))
+    print_words_top(rank_refs(score, words_of_user))
 
 if __name__ == '__main__':
   main()
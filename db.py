@@ -1,31 +1,75 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from collections.abc import MutableMapping
+from itertools import islice
+from pathlib import Path
+
+import calendar
+import dbm
+import json
+import os
+import pickle
+import shelve
+import shutil
+import sqlite3
+import struct
+import time
+
+# Records use __slots__ and store ids as ints, to keep millions of them in
+# memory. They pickle as version-tagged tuples; __setstate__ also accepts the
+# __dict__ of version 0 records (string ids, sets), so old databases load.
+# Version 2 added Tweet.norm.
+FORMAT_VERSION = 2
+
 class User:
+  __slots__ = ('screen_name',)
   def __init__(self, screen_name):
     self.screen_name = screen_name
     # TODO: self.is_trusted = False
+  def __getstate__(self):
+    return (FORMAT_VERSION, self.screen_name)
+  def __setstate__(self, state):
+    if isinstance(state, dict):
+      self.screen_name = state['screen_name']
+    else:
+      _, self.screen_name = state
 
 class Mention:
-  def __init__(self):
-    self.users = set()
-    self.urls = set()
-    self.tweets = set()
+  __slots__ = ('users', 'urls', 'tweets')
+  def __init__(self, users=(), urls=(), tweets=()):
+    self.users = tuple(sorted(int(u) for u in users))
+    self.urls = tuple(sorted(urls))
+    self.tweets = tuple(sorted(int(t) for t in tweets))
   def __str__(self):
-    result = '(users: ' + ' '.join(self.users) + ')'
+    result = '(users: ' + ' '.join(map(str, self.users)) + ')'
     result += ' (urls: ' + ' '.join(self.urls) + ')'
-    result += ' (tweets: ' + ' '.join(self.tweets) + ')'
+    result += ' (tweets: ' + ' '.join(map(str, self.tweets)) + ')'
     return result
   def as_dict(self):
     result = {}
-    result['users'] = sorted(self.users)
-    result['urls'] = sorted(self.urls)
-    result['tweets'] = sorted(self.tweets)
+    result['users'] = list(self.users)
+    result['urls'] = list(self.urls)
+    result['tweets'] = list(self.tweets)
     return result
+  def __getstate__(self):
+    return (FORMAT_VERSION, self.users, self.urls, self.tweets)
+  def __setstate__(self, state):
+    if isinstance(state, dict):
+      self.__init__(state['users'], state['urls'], state['tweets'])
+    else:
+      _, self.users, self.urls, self.tweets = state
 
 class Tweet:
-  def __init__(self, text, time, author, mention):
+  __slots__ = ('text', 'time', 'author', 'mention', 'norm')
+  # norm is the version of the url cache that mention.urls were normalized
+  # against; 0 means not normalized.
+  def __init__(self, text, time, author, mention, norm=0):
     self.text = text
     self.time = time
-    self.author = author
+    self.author = int(author)
     self.mention = mention
+    self.norm = norm
   def __str__(self):
     return 'author: {}\ntime: {}\nmention: {}\ntext: {}\n'.format(
       self.author, self.time, self.mention, self.text
@@ -33,3 +77,689 @@ class Tweet:
   def as_dict(self):
     return { 'text':self.text, 'time':self.time, 'author':self.author
             , 'mention':self.mention.as_dict() }
+  # The mention is flattened into the tweet, to save one object per record.
+  def __getstate__(self):
+    m = self.mention
+    return (FORMAT_VERSION, self.text, self.time, self.author,
+      m.users, m.urls, m.tweets, self.norm)
+  def __setstate__(self, state):
+    if isinstance(state, dict):
+      self.__init__(state['text'], state['time'], state['author'], state['mention'])
+      return
+    if state[0] == 1:
+      _, self.text, self.time, self.author, users, urls, tweets = state
+      self.norm = 0
+    else:
+      _, self.text, self.time, self.author, users, urls, tweets, self.norm = state
+    self.mention = Mention.__new__(Mention)
+    self.mention.users, self.mention.urls, self.mention.tweets = users, urls, tweets
+
+# The counts of the tweets of one hour, in db/rollups; see rollups.py. The
+# ids are kept so that a tweet added twice is counted once; merged buckets,
+# which answer queries, have none.
+class Bucket:
+  __slots__ = ('ids', 'count', 'authors', 'mentions', 'words', 'urls')
+  def __init__(self):
+    self.ids = set()
+    self.count = 0
+    self.authors = Counter()
+    self.mentions = Counter()
+    self.words = Counter()
+    self.urls = Counter()
+  def __getstate__(self):
+    return (FORMAT_VERSION, self.ids, self.count, self.authors, self.mentions,
+      self.words, self.urls)
+  def __setstate__(self, state):
+    (_, self.ids, self.count, self.authors, self.mentions, self.words,
+      self.urls) = state
+
+  def add(self, i, t, words):
+    if i in self.ids:
+      return False
+    self.ids.add(i)
+    self.count += 1
+    self.authors[t.author] += 1
+    # Self-mentions are not edges, as for rank_users.py and cluster.py.
+    for u in t.mention.users:
+      if u != t.author:
+        self.mentions[t.author, u] += 1
+    self.words.update(words)
+    self.urls.update(t.mention.urls)
+    return True
+
+  def merge(self, other):
+    self.count += other.count
+    self.authors.update(other.authors)
+    self.mentions.update(other.mentions)
+    self.words.update(other.words)
+    self.urls.update(other.urls)
+
+#{{{ parsing of API statuses
+def time_of_raw_tweet(t):
+  assert 'created_at' in t
+  return calendar.timegm(time.strptime(t['created_at'],
+    '%a %b %d %H:%M:%S +0000 %Y'))
+
+def users_of_status(t):
+  '''(id, screen_name) of the author and of the users the status mentions.'''
+  yield t['user']['id_str'], t['user']['screen_name']
+  for u in t['entities']['user_mentions']:
+    yield u['id_str'], u['screen_name']
+  if t['in_reply_to_user_id_str'] and t['in_reply_to_screen_name']:
+    yield t['in_reply_to_user_id_str'], t['in_reply_to_screen_name']
+
+def tweet_of_status(t):
+  users, urls, refs = set(), set(), set()
+  for u in t['entities']['user_mentions']:
+    users.add(u['id_str'])
+  if t['in_reply_to_user_id_str']:
+    users.add(t['in_reply_to_user_id_str'])
+  for u in t['entities']['urls']:
+    urls.add(u['expanded_url'])
+  for k in ['retweeted_status', 'quoted_status']:
+    if k in t:
+      refs.add(t[k]['id_str'])
+      users.add(t[k]['user']['id_str'])
+      for u in t[k]['entities']['urls']:
+        urls.add(u['expanded_url'])
+  mention = Mention(users, urls, refs)
+  return Tweet(t['text'], time_of_raw_tweet(t), t['user']['id_str'], mention)
+#}}}
+
+#{{{ storage
+# All scripts reach db/ through open_tweets (for collections of tweets, such
+# as db/tweets and db/slice) and open_map (for everything else, such as
+# db/users or db/userrank). There are two backends:
+#   sqlite  one file, db/twitstat.sqlite, with indexes on tweet time, author,
+#           and mentioned users/urls
+#   shelve  one pickled shelve file per collection, as in old databases
+# The backend is the 'backend' key of db/config.json if present; otherwise
+# sqlite, unless there is an old shelve database around. Use switch_db.py to
+# convert between the two.
+
+DB_DIR = Path('db')
+SQLITE_PATH = DB_DIR / 'twitstat.sqlite'
+TWEET_TABLES = ['tweets', 'slice']
+MAPS = ['users', 'userrank', 'urlrank', 'urls', 'pprcache', 'endorsers',
+  'shared', 'rollups']
+SHELVE_SUFFIXES = ['', '.db', '.dat', '.dir', '.bak', '.timeidx']
+
+def shelve_exists(name):
+  return dbm.whichdb(str(DB_DIR / name)) is not None
+
+_backend = None
+def backend():
+  global _backend
+  if _backend is None:
+    try:
+      with (DB_DIR / 'config.json').open() as config:
+        _backend = json.load(config).get('backend')
+    except (OSError, ValueError):
+      pass
+  if _backend is None:
+    if not SQLITE_PATH.exists() and any(shelve_exists(n) for n in TWEET_TABLES):
+      _backend = 'shelve'
+    else:
+      _backend = 'sqlite'
+  return _backend
+
+def open_tweets(name, flag='c', backend_name=None):
+  '''Opens a collection of tweets, keyed by tweet id.
+
+  Besides the mapping interface, it supports between(start, stop) and
+  author_urls(), which the sqlite backend answers from indexes.'''
+  if (backend_name or backend()) == 'sqlite':
+    return SqliteTweets(_connection(), name, flag)
+  return ShelveTweets(str(DB_DIR / name), flag)
+
+def open_map(name, flag='c', backend_name=None):
+  if (backend_name or backend()) == 'sqlite':
+    return SqliteMap(_connection(), name, flag)
+  return shelve.open(str(DB_DIR / name), flag)
+
+def rename_tweets(src, dst, backend_name=None):
+  '''Moves tweet collection src to dst, replacing dst.'''
+  if (backend_name or backend()) == 'sqlite':
+    conn = _connection()
+    for suffix in SQLITE_CHILDREN:
+      conn.execute('DROP TABLE IF EXISTS {}'.format(_q(dst + suffix)))
+    # Indexes keep their names when tables are renamed.
+    _drop_indexes(conn, src)
+    for suffix in SQLITE_CHILDREN:
+      conn.execute('ALTER TABLE {} RENAME TO {}'.format(
+        _q(src + suffix), _q(dst + suffix)))
+    _create_tweet_tables(conn, dst)
+    conn.commit()
+  else:
+    for suffix in SHELVE_SUFFIXES:
+      s = DB_DIR / (src + suffix)
+      if s.exists():
+        shutil.move(str(s), str(DB_DIR / (dst + suffix)))
+
+# A virtual slice is a manifest, db/slice.ids, instead of a copy of the
+# tweets: a header with the time bounds, then the sorted tweet ids as an
+# array of 64 bit ints. While it exists, open_slice reads through it from
+# db/tweets; otherwise it opens the copied db/slice.
+SLICE_MANIFEST = DB_DIR / 'slice.ids'
+SLICE_MAGIC = b'SLC1'
+SLICE_HEADER = struct.Struct('<4sddQ')
+
+def open_slice(flag='c'):
+  if SLICE_MANIFEST.exists() and flag != 'n':
+    start, stop, ids = read_slice_manifest()
+    return SliceView(open_tweets('tweets', flag), start, stop, ids)
+  return open_tweets('slice', flag)
+
+def read_slice_manifest():
+  with SLICE_MANIFEST.open('rb') as f:
+    magic, start, stop, n = SLICE_HEADER.unpack(f.read(SLICE_HEADER.size))
+    if magic != SLICE_MAGIC:
+      raise ValueError('{} is not a slice manifest'.format(SLICE_MANIFEST))
+    ids = array('Q')
+    ids.fromfile(f, n)
+  return start, stop, ids
+
+def write_slice_manifest(start, stop, ids):
+  ids = array('Q', sorted(int(i) for i in ids))
+  tmp = SLICE_MANIFEST.with_suffix('.tmp')
+  with tmp.open('wb') as f:
+    f.write(SLICE_HEADER.pack(SLICE_MAGIC, start, stop, len(ids)))
+    ids.tofile(f)
+  tmp.replace(SLICE_MANIFEST)
+
+def remove_slice_manifest():
+  if SLICE_MANIFEST.exists():
+    SLICE_MANIFEST.unlink()
+
+# Reverse indexes of db/slice, for queries by url and by user, with screen
+# names filled in: db/endorsers maps each url to the sorted screen names of
+# those who mentioned it; db/shared maps each lowercase screen name to the
+# screen name and the urls mentioned, repeats included. Whatever changes the
+# slice, or the users, calls touch_slice(), which stores a new stamp in
+# db/slice.stamp; the indexes remember the stamp they were built from, under
+# a key that is neither a url nor a screen name, and are rebuilt when it
+# differs.
+SLICE_STAMP = DB_DIR / 'slice.stamp'
+INDEX_STAMP_KEY = ' stamp'
+
+def touch_slice():
+  stamp = '{}.{}'.format(time.time_ns(), os.getpid())
+  tmp = DB_DIR / 'slice.stamp.tmp'
+  tmp.write_text(stamp)
+  tmp.replace(SLICE_STAMP)
+  return stamp
+
+def slice_stamp():
+  try:
+    return SLICE_STAMP.read_text()
+  except OSError:
+    return touch_slice()
+
+def open_slice_indexes():
+  '''Returns the maps (endorsers, shared), rebuilt first if stale.'''
+  stamp = slice_stamp()
+  endorsers = open_map('endorsers')
+  shared = open_map('shared')
+  if endorsers.get(INDEX_STAMP_KEY) != stamp or \
+      shared.get(INDEX_STAMP_KEY) != stamp:
+    endorsers.close()
+    shared.close()
+    build_slice_indexes(stamp)
+    endorsers = open_map('endorsers')
+    shared = open_map('shared')
+  return endorsers, shared
+
+def build_slice_indexes(stamp):
+  urls_of_user = {}
+  with open_slice() as tweets:
+    for a, u in tweets.author_urls():
+      urls_of_user.setdefault(a, []).append(u)
+  names_of_url = {}
+  with open_map('shared', 'n') as shared:
+    with open_map('users') as users:
+      entries = {}
+      for a, ls in urls_of_user.items():
+        name = users[str(a)].screen_name if str(a) in users else \
+          'unknown-{}'.format(a)
+        entries[name.lower()] = (name, ls)
+        for u in ls:
+          names_of_url.setdefault(u, set()).add(name)
+    shared.update(entries)
+    shared[INDEX_STAMP_KEY] = stamp
+  with open_map('endorsers', 'n') as endorsers:
+    endorsers.update((u, sorted(ns)) for u, ns in names_of_url.items())
+    endorsers[INDEX_STAMP_KEY] = stamp
+
+# A shelve has no order, so ShelveTweets keeps a time index next to it, in
+# <name>.timeidx: a header, then the tweet times and the tweet ids, each as
+# a sorted array of 64 bit ints. Writes are collected in memory and merged
+# into the index on sync/close.
+TIME_INDEX_MAGIC = b'TIX1'
+TIME_INDEX_HEADER = struct.Struct('<4sQ')
+
+class ShelveTweets(MutableMapping):
+  def __init__(self, path, flag):
+    self.shelf = shelve.open(path, flag)
+    self.index_path = Path(path + '.timeidx')
+    self.times = None
+    self.ids = None
+    self.pending = {}
+    self.removed = set()
+    self.replaced = set()
+    if flag == 'n' and self.index_path.exists():
+      self.index_path.unlink()
+  def __enter__(self):
+    return self
+  def __exit__(self, *exc):
+    self.close()
+  def close(self):
+    self.flush_index()
+    self.shelf.close()
+  def sync(self):
+    self.flush_index()
+    self.shelf.sync()
+  def __getitem__(self, i):
+    return self.shelf[i]
+  def __setitem__(self, i, t):
+    if i in self.removed or (i not in self.pending and i in self.shelf):
+      self.replaced.add(i)
+    self.shelf[i] = t
+    self.pending[i] = t.time
+    self.removed.discard(i)
+  def __delitem__(self, i):
+    del self.shelf[i]
+    self.pending.pop(i, None)
+    self.removed.add(i)
+  def __contains__(self, i):
+    return i in self.shelf
+  def __iter__(self):
+    return iter(self.shelf)
+  def __len__(self):
+    return len(self.shelf)
+
+  def load_index(self):
+    if self.times is not None:
+      return
+    self.times, self.ids = array('q'), array('Q')
+    try:
+      with self.index_path.open('rb') as f:
+        magic, n = TIME_INDEX_HEADER.unpack(f.read(TIME_INDEX_HEADER.size))
+        if magic == TIME_INDEX_MAGIC:
+          self.times.fromfile(f, n)
+          self.ids.fromfile(f, n)
+    except (OSError, EOFError, struct.error):
+      self.times, self.ids = array('q'), array('Q')
+
+  def locate(self, t, i):
+    '''Position of (t, i) in the index, or None.'''
+    lo = bisect_left(self.times, t)
+    hi = bisect_right(self.times, t, lo)
+    p = lo + bisect_left(self.ids[lo:hi], i)
+    return p if p < hi and self.ids[p] == i else None
+
+  # Only the pending entries are sorted; they are merged into the arrays by
+  # copying the runs between them. A tweet written again with the same time
+  # is already in place. The arrays are filtered, which is the one pass over
+  # the whole index, only for deleted tweets and tweets whose time changed.
+  def flush_index(self):
+    if not self.pending and not self.removed:
+      return
+    self.load_index()
+    fresh = sorted((int(t), int(i)) for i, t in self.pending.items()
+      if i not in self.replaced or self.locate(int(t), int(i)) is None)
+    drop = set(int(i) for i in self.removed)
+    drop.update(i for _, i in fresh if str(i) in self.replaced)
+    if drop:
+      self.times = array('q',
+        (t for t, i in zip(self.times, self.ids) if i not in drop))
+      self.ids = array('Q', (i for i in self.ids if i not in drop))
+    times, ids = array('q'), array('Q')
+    done = 0
+    for t, i in fresh:
+      lo = bisect_left(self.times, t, done)
+      hi = bisect_right(self.times, t, lo)
+      p = lo + bisect_left(self.ids[lo:hi], i)
+      times.extend(self.times[done:p])
+      ids.extend(self.ids[done:p])
+      times.append(t)
+      ids.append(i)
+      done = p
+    times.extend(self.times[done:])
+    ids.extend(self.ids[done:])
+    self.times, self.ids = times, ids
+    with self.index_path.open('wb') as f:
+      f.write(TIME_INDEX_HEADER.pack(TIME_INDEX_MAGIC, len(self.times)))
+      self.times.tofile(f)
+      self.ids.tofile(f)
+    self.pending = {}
+    self.removed = set()
+    self.replaced = set()
+
+  def between(self, start, stop):
+    '''Tweets with start <= time < stop, in time order.'''
+    for i in self.ids_between(start, stop):
+      yield i, self.shelf[i]
+  def ids_between(self, start, stop):
+    self.flush_index()
+    self.load_index()
+    if len(self.times) != len(self.shelf):
+      # Missing, or written by something that doesn't know about it.
+      self.times, self.ids = array('q'), array('Q')
+      self.pending = {i: t.time for i, t in self.shelf.items()}
+      self.flush_index()
+    lo = bisect_left(self.times, start)
+    hi = bisect_left(self.times, stop)
+    return [str(i) for i in self.ids[lo:hi]]
+  def author_urls(self):
+    for t in self.shelf.values():
+      for u in t.mention.urls:
+        yield t.author, u
+  def stale_urls(self, version):
+    '''(id, url) pairs of tweets normalized against an older url cache.'''
+    for i, t in self.shelf.items():
+      if t.norm < version:
+        for u in t.mention.urls:
+          yield i, u
+  def mark_normalized(self, ids, version):
+    # Marking would mean rewriting the records; stale_urls reads them all
+    # anyway, so unchanged tweets are left alone.
+    pass
+
+_conn = None
+def _connection():
+  global _conn
+  if _conn is None:
+    DB_DIR.mkdir(exist_ok=True)
+    _conn = sqlite3.connect(str(SQLITE_PATH))
+    _conn.execute('PRAGMA journal_mode=WAL')
+    _conn.execute('PRAGMA synchronous=NORMAL')
+  return _conn
+
+def _q(name):
+  return '"{}"'.format(name.replace('"', '""'))
+
+UPDATE_BATCH = 10000
+
+# The mention sets of a tweet live in child tables, one row per element.
+SQLITE_CHILDREN = ['', '_users', '_urls', '_refs']
+MENTION_COLUMNS = [('_users', 'user', 'INTEGER'), ('_urls', 'url', 'TEXT'),
+  ('_refs', 'ref', 'INTEGER')]
+
+def _create_tweet_tables(conn, t):
+  conn.execute('CREATE TABLE IF NOT EXISTS {} '
+    '(id TEXT PRIMARY KEY, time INTEGER, author INTEGER, text TEXT, '
+    'norm INTEGER NOT NULL DEFAULT 0)'.format(_q(t)))
+  columns = [c[1] for c in conn.execute('PRAGMA table_info({})'.format(_q(t)))]
+  if 'norm' not in columns:
+    conn.execute('ALTER TABLE {} ADD COLUMN norm INTEGER NOT NULL DEFAULT 0'
+      .format(_q(t)))
+  conn.execute('CREATE INDEX IF NOT EXISTS {} ON {}(time)'.format(
+    _q(t + '_by_time'), _q(t)))
+  conn.execute('CREATE INDEX IF NOT EXISTS {} ON {}(author)'.format(
+    _q(t + '_by_author'), _q(t)))
+  conn.execute('CREATE INDEX IF NOT EXISTS {} ON {}(norm)'.format(
+    _q(t + '_by_norm'), _q(t)))
+  for suffix, column, column_type in MENTION_COLUMNS:
+    conn.execute('CREATE TABLE IF NOT EXISTS {} (tweet TEXT, {} {})'.format(
+      _q(t + suffix), column, column_type))
+    conn.execute('CREATE INDEX IF NOT EXISTS {} ON {}(tweet)'.format(
+      _q(t + suffix + '_by_tweet'), _q(t + suffix)))
+    conn.execute('CREATE INDEX IF NOT EXISTS {} ON {}({})'.format(
+      _q(t + suffix + '_by_' + column), _q(t + suffix), column))
+
+def _drop_indexes(conn, t):
+  conn.execute('DROP INDEX IF EXISTS {}'.format(_q(t + '_by_time')))
+  conn.execute('DROP INDEX IF EXISTS {}'.format(_q(t + '_by_author')))
+  conn.execute('DROP INDEX IF EXISTS {}'.format(_q(t + '_by_norm')))
+  for suffix, column, _ in MENTION_COLUMNS:
+    conn.execute('DROP INDEX IF EXISTS {}'.format(_q(t + suffix + '_by_tweet')))
+    conn.execute('DROP INDEX IF EXISTS {}'.format(_q(t + suffix + '_by_' + column)))
+
+class SqliteTweets(MutableMapping):
+  def __init__(self, conn, name, flag):
+    self.conn = conn
+    self.name = name
+    _create_tweet_tables(conn, name)
+    if flag == 'n':
+      self.clear()
+    t = _q(name)
+    # Mentioned ids and urls never contain spaces.
+    self.select = ('SELECT id, time, author, text, norm'
+      + ''.join(', (SELECT group_concat({c}, \' \') FROM {ct} WHERE tweet = t.id)'
+          .format(c=c, ct=_q(name + s)) for s, c, _ in MENTION_COLUMNS)
+      + ' FROM {} AS t'.format(t))
+  def __enter__(self):
+    return self
+  def __exit__(self, *exc):
+    self.close()
+  def close(self):
+    self.conn.commit()
+  def sync(self):
+    self.conn.commit()
+
+  def _tweet(self, row):
+    _, time, author, text, norm, users, urls, refs = row
+    mention = Mention(
+      users.split() if users else (),
+      urls.split() if urls else (),
+      refs.split() if refs else ())
+    return Tweet(text, time, author, mention, norm)
+
+  def __getitem__(self, i):
+    row = self.conn.execute(self.select + ' WHERE id = ?', (i,)).fetchone()
+    if row is None:
+      raise KeyError(i)
+    return self._tweet(row)
+  def __setitem__(self, i, t):
+    self.update([(i, t)])
+  def __delitem__(self, i):
+    if i not in self:
+      raise KeyError(i)
+    for suffix in SQLITE_CHILDREN:
+      column = 'id' if suffix == '' else 'tweet'
+      self.conn.execute('DELETE FROM {} WHERE {} = ?'.format(
+        _q(self.name + suffix), column), (i,))
+  def __contains__(self, i):
+    return self.conn.execute('SELECT 1 FROM {} WHERE id = ?'.format(
+      _q(self.name)), (i,)).fetchone() is not None
+  def __iter__(self):
+    for (i,) in self.conn.execute('SELECT id FROM {}'.format(_q(self.name))):
+      yield i
+  def __len__(self):
+    return self.conn.execute('SELECT count(*) FROM {}'.format(
+      _q(self.name))).fetchone()[0]
+  def clear(self):
+    for suffix in SQLITE_CHILDREN:
+      self.conn.execute('DELETE FROM {}'.format(_q(self.name + suffix)))
+
+  def items(self):
+    for row in self.conn.execute(self.select):
+      yield row[0], self._tweet(row)
+  def values(self):
+    for _, t in self.items():
+      yield t
+
+  def update(self, items=()):
+    '''Bulk insert or replace, with one executemany per table and batch.'''
+    if hasattr(items, 'items'):
+      items = items.items()
+    items = iter(items)
+    while True:
+      batch = list(islice(items, UPDATE_BATCH))
+      if not batch:
+        break
+      self.update_batch(batch)
+
+  def update_batch(self, items):
+    ids = [(i,) for i, _ in items]
+    for suffix, _, _ in MENTION_COLUMNS:
+      self.conn.executemany('DELETE FROM {} WHERE tweet = ?'.format(
+        _q(self.name + suffix)), ids)
+    self.conn.executemany(
+      'INSERT OR REPLACE INTO {} (id, time, author, text, norm) '
+      'VALUES (?, ?, ?, ?, ?)'.format(_q(self.name)),
+      ((i, t.time, t.author, t.text, t.norm) for i, t in items))
+    for (suffix, _, _), field in zip(MENTION_COLUMNS, ['users', 'urls', 'tweets']):
+      self.conn.executemany(
+        'INSERT INTO {} VALUES (?, ?)'.format(_q(self.name + suffix)),
+        ((i, x) for i, t in items for x in getattr(t.mention, field)))
+
+  def between(self, start, stop):
+    '''Tweets with start <= time < stop, in time order.'''
+    for row in self.conn.execute(
+        self.select + ' WHERE time >= ? AND time < ? ORDER BY time',
+        (start, stop)):
+      yield row[0], self._tweet(row)
+  def ids_between(self, start, stop):
+    return [i for (i,) in self.conn.execute(
+      'SELECT id FROM {} WHERE time >= ? AND time < ? ORDER BY time'.format(
+        _q(self.name)), (start, stop))]
+  def author_urls(self):
+    return self.conn.execute(
+      'SELECT t.author, u.url FROM {} AS t JOIN {} AS u ON u.tweet = t.id'
+      .format(_q(self.name), _q(self.name + '_urls')))
+  def stale_urls(self, version):
+    '''(id, url) pairs of tweets normalized against an older url cache.'''
+    return self.conn.execute(
+      'SELECT t.id, u.url FROM {} AS t JOIN {} AS u ON u.tweet = t.id '
+      'WHERE t.norm < ?'.format(_q(self.name), _q(self.name + '_urls')),
+      (version,))
+  def mark_normalized(self, ids, version):
+    self.conn.executemany('UPDATE {} SET norm = ? WHERE id = ?'.format(
+      _q(self.name)), ((version, i) for i in ids))
+
+# Writes go through to db/tweets, so urls normalized in a virtual slice are
+# normalized in db/tweets too.
+class SliceView(MutableMapping):
+  def __init__(self, tweets, start, stop, ids):
+    self.tweets = tweets
+    self.start = start
+    self.stop = stop
+    self.ids = ids
+  def __enter__(self):
+    return self
+  def __exit__(self, *exc):
+    self.close()
+  def close(self):
+    self.tweets.close()
+  def sync(self):
+    self.tweets.sync()
+
+  def _has(self, i):
+    try:
+      i = int(i)
+    except ValueError:
+      return False
+    k = bisect_left(self.ids, i)
+    return k < len(self.ids) and self.ids[k] == i
+  def __getitem__(self, i):
+    if not self._has(i):
+      raise KeyError(i)
+    return self.tweets[i]
+  def __setitem__(self, i, t):
+    if not self._has(i):
+      raise KeyError('{} is not in the slice'.format(i))
+    self.tweets[i] = t
+  def __delitem__(self, i):
+    raise TypeError('cannot delete from a virtual slice')
+  def __contains__(self, i):
+    return self._has(i) and i in self.tweets
+  def __iter__(self):
+    for i in self.ids:
+      yield str(i)
+  def __len__(self):
+    return len(self.ids)
+
+  def update(self, items=()):
+    if hasattr(items, 'items'):
+      items = items.items()
+    def checked():
+      for i, t in items:
+        if not self._has(i):
+          raise KeyError('{} is not in the slice'.format(i))
+        yield i, t
+    self.tweets.update(checked())
+  def between(self, start, stop):
+    for i, t in self.tweets.between(max(start, self.start), min(stop, self.stop)):
+      if self._has(i):
+        yield i, t
+  def items(self):
+    return self.between(self.start, self.stop)
+  def values(self):
+    for _, t in self.items():
+      yield t
+  def author_urls(self):
+    for t in self.values():
+      for u in t.mention.urls:
+        yield t.author, u
+  def stale_urls(self, version):
+    for i, t in self.items():
+      if t.norm < version:
+        for u in t.mention.urls:
+          yield i, u
+  def mark_normalized(self, ids, version):
+    self.tweets.mark_normalized((i for i in ids if self._has(i)), version)
+
+# Values are stored as they are used by the scripts: screen names for users,
+# floats for scores, and pickles for anything else.
+MAP_CODECS = {
+  'users': ('TEXT', lambda u: u.screen_name, User),
+  'userrank': ('REAL', float, float),
+  'urlrank': ('REAL', float, float) }
+PICKLE_CODEC = ('BLOB', pickle.dumps, pickle.loads)
+
+class SqliteMap(MutableMapping):
+  def __init__(self, conn, name, flag):
+    self.conn = conn
+    self.table = _q('map_' + name)
+    column_type, self.encode, self.decode = MAP_CODECS.get(name, PICKLE_CODEC)
+    conn.execute('CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value {})'
+      .format(self.table, column_type))
+    if flag == 'n':
+      self.clear()
+  def __enter__(self):
+    return self
+  def __exit__(self, *exc):
+    self.close()
+  def close(self):
+    self.conn.commit()
+  def sync(self):
+    self.conn.commit()
+
+  def __getitem__(self, k):
+    row = self.conn.execute('SELECT value FROM {} WHERE key = ?'.format(
+      self.table), (k,)).fetchone()
+    if row is None:
+      raise KeyError(k)
+    return self.decode(row[0])
+  def __setitem__(self, k, v):
+    self.conn.execute('INSERT OR REPLACE INTO {} VALUES (?, ?)'.format(
+      self.table), (k, self.encode(v)))
+  def __delitem__(self, k):
+    if k not in self:
+      raise KeyError(k)
+    self.conn.execute('DELETE FROM {} WHERE key = ?'.format(self.table), (k,))
+  def __contains__(self, k):
+    return self.conn.execute('SELECT 1 FROM {} WHERE key = ?'.format(
+      self.table), (k,)).fetchone() is not None
+  def __iter__(self):
+    for (k,) in self.conn.execute('SELECT key FROM {}'.format(self.table)):
+      yield k
+  def __len__(self):
+    return self.conn.execute('SELECT count(*) FROM {}'.format(
+      self.table)).fetchone()[0]
+  def clear(self):
+    self.conn.execute('DELETE FROM {}'.format(self.table))
+
+  def items(self):
+    for k, v in self.conn.execute('SELECT key, value FROM {}'.format(self.table)):
+      yield k, self.decode(v)
+  def values(self):
+    for _, v in self.items():
+      yield v
+  def update(self, items=()):
+    if hasattr(items, 'items'):
+      items = items.items()
+    self.conn.executemany('INSERT OR REPLACE INTO {} VALUES (?, ?)'.format(
+      self.table), ((k, self.encode(v)) for k, v in items))
+#}}}
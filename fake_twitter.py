@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Lock
+from time import sleep, time
+from urllib.parse import parse_qs, quote, urlsplit
+
+import archive
+import gzip
+import json
+import random
+import re
+import signal
+import sys
+import synthetic
+
+argparser = ArgumentParser(description='''
+  A stand-in for the parts of the Twitter API that fetch_tweets.py and
+  oauth.py use, for testing and benchmarking offline. It serves pages of
+  search/tweets.json from a synthetic corpus, or from recorded statuses,
+  with rate limit headers, and optionally with latency and errors. Point
+  the scripts at it with -api http://localhost:PORT. Urls under /r/N/
+  redirect N times, for normalize_urls.py.
+''')
+
+argparser.add_argument('-p', '--port', default=8080, type=int,
+  help='port to listen on')
+argparser.add_argument('-n', '--size', default=100000, type=int,
+  help='statuses in the synthetic corpus')
+argparser.add_argument('-s', '--seed', default=0, type=int,
+  help='seed of the synthetic corpus')
+argparser.add_argument('-f', '--fixtures', nargs='+',
+  help='serve these statuses instead: JSONL files, possibly gzipped, or '
+  'archive directories such as db/archive')
+argparser.add_argument('-l', '--rate-limit', default=450, type=int,
+  help='search requests allowed per window')
+argparser.add_argument('-w', '--window', default=900, type=float,
+  help='length of the rate limit window, in seconds')
+argparser.add_argument('-t', '--latency', default=0, type=float,
+  help='mean latency of a response, in seconds')
+argparser.add_argument('-e', '--error-rate', default=0, type=float,
+  help='fraction of search requests that fail with 503')
+argparser.add_argument('-v', '--verbose', action='store_true',
+  help='log every request')
+
+SEARCH_PATH = '/1.1/search/tweets.json'
+TOKEN_PATH = '/oauth2/token'
+TOKEN = 'fake-access-token'
+MAX_COUNT = 100
+
+args = None
+
+#{{{ sources of statuses
+# Both sources are sequences of statuses, newest first, with first_at_most(i)
+# giving the position of the newest status whose id is at most i.
+class Fixtures:
+  def __init__(self, paths):
+    by_id = {}
+    for path in paths:
+      for s in read_statuses(Path(path)):
+        by_id[s['id_str']] = s
+    self.statuses = sorted(by_id.values(), key=lambda s: -int(s['id_str']))
+    self.keys = [-int(s['id_str']) for s in self.statuses]
+  def __len__(self):
+    return len(self.statuses)
+  def __getitem__(self, k):
+    return self.statuses[k]
+  def first_at_most(self, i):
+    return bisect_left(self.keys, -i)
+
+def read_statuses(path):
+  if path.is_dir():
+    for segment in sorted(path.glob('*.jsonl.gz')):
+      yield from archive.read_segment(segment)
+    return
+  opener = gzip.open if path.suffix == '.gz' else open
+  with opener(str(path), 'rt') as f:
+    for line in f:
+      if line.strip():
+        yield json.loads(line)
+
+class SyntheticSource(synthetic.Corpus):
+  def first_at_most(self, i):
+    return max(0, self.index_of(i))
+#}}}
+
+# One rate limit window for everybody, as for a single application token.
+class RateLimit:
+  def __init__(self, limit, window):
+    self.limit = limit
+    self.window = window
+    self.lock = Lock()
+    self.reset = time() + window
+    self.remaining = limit
+  def take(self):
+    with self.lock:
+      if time() >= self.reset:
+        self.reset = time() + self.window
+        self.remaining = self.limit
+      ok = self.remaining > 0
+      self.remaining = max(0, self.remaining - 1)
+      return ok, {
+        'x-rate-limit-limit': str(self.limit),
+        'x-rate-limit-remaining': str(self.remaining),
+        'x-rate-limit-reset': str(int(self.reset))}
+
+source = None
+rate_limit = None
+served = {'search': 0, 'statuses': 0, 'errors': 0, 'limited': 0}
+
+def search(params):
+  count = min(MAX_COUNT, int(params.get('count', ['15'])[0]))
+  q = params.get('q', [''])[0]
+  authors = {a.lower() for a in re.findall(r'from:(\w+)', q)}
+  k = 0
+  if 'max_id' in params:
+    k = source.first_at_most(int(params['max_id'][0]))
+  statuses = []
+  while k < len(source) and len(statuses) < count:
+    s = source[k]
+    if not authors or s['user']['screen_name'].lower() in authors:
+      statuses.append(s)
+    k += 1
+  metadata = {'count': count, 'query': quote(q)}
+  if statuses and k < len(source):
+    metadata['next_results'] = '?max_id={}&q={}&count={}&include_entities=1' \
+      '&result_type=recent'.format(int(statuses[-1]['id_str']) - 1, quote(q),
+        count)
+  return {'statuses': statuses, 'search_metadata': metadata}
+
+def error(code, message):
+  return {'errors': [{'code': code, 'message': message}]}
+
+class Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, *a):
+    if args.verbose:
+      super().log_message(*a)
+
+  def reply(self, status, body, headers={}):
+    data = json.dumps(body).encode()
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json;charset=utf-8')
+    self.send_header('Content-Length', str(len(data)))
+    for k, v in headers.items():
+      self.send_header(k, v)
+    self.end_headers()
+    self.wfile.write(data)
+
+  def do_POST(self):
+    self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    if urlsplit(self.path).path != TOKEN_PATH:
+      return self.reply(404, error(34, 'Sorry, that page does not exist.'))
+    self.reply(200, {'token_type': 'bearer', 'access_token': TOKEN})
+
+  # /r/N/anything redirects N times, ending at /r/0/anything; these stand in
+  # for the link shorteners that normalize_urls.py resolves.
+  def redirect(self):
+    _, _, n, rest = self.path.split('/', 3)
+    if n.isdigit() and int(n) > 0:
+      self.send_response(301)
+      self.send_header('Location', '/r/{}/{}'.format(int(n) - 1, rest))
+    else:
+      self.send_response(200)
+      self.send_header('Content-Type', 'text/html')
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+  def do_HEAD(self):
+    if self.path.startswith('/r/'):
+      return self.redirect()
+    self.send_response(405)
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+  def do_GET(self):
+    if self.path.startswith('/r/'):
+      return self.redirect()
+    url = urlsplit(self.path)
+    if url.path != SEARCH_PATH:
+      return self.reply(404, error(34, 'Sorry, that page does not exist.'))
+    if args.latency:
+      sleep(random.expovariate(1 / args.latency))
+    if self.headers.get('Authorization') != 'Bearer {}'.format(TOKEN):
+      return self.reply(401, error(89, 'Invalid or expired token.'))
+    ok, headers = rate_limit.take()
+    if not ok:
+      served['limited'] += 1
+      return self.reply(429, error(88, 'Rate limit exceeded'), headers)
+    if random.random() < args.error_rate:
+      served['errors'] += 1
+      return self.reply(503, error(130, 'Over capacity'), headers)
+    page = search(parse_qs(url.query))
+    served['search'] += 1
+    served['statuses'] += len(page['statuses'])
+    self.reply(200, page, headers)
+
+def main():
+  global args, source, rate_limit
+  args = argparser.parse_args()
+  if args.fixtures:
+    source = Fixtures(args.fixtures)
+  else:
+    source = SyntheticSource(args.size, seed=args.seed)
+  rate_limit = RateLimit(args.rate_limit, args.window)
+  server = ThreadingHTTPServer(('localhost', args.port), Handler)
+  # Also stop cleanly on SIGTERM: in the background, SIGINT is ignored.
+  signal.signal(signal.SIGTERM, signal.default_int_handler)
+  sys.stderr.write('serving {} statuses on http://localhost:{}\n'.format(
+    len(source), args.port))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  sys.stderr.write('served {search} pages with {statuses} statuses; '
+    '{errors} errors, {limited} rate limited\n'.format(**served))
+
+if __name__ == '__main__':
+  main()
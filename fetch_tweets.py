@@ -2,15 +2,20 @@
 # vim: set fileencoding=utf-8 :
 
 from argparse import ArgumentParser
-from calendar import timegm
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from time import sleep, strptime, time
+from requests.adapters import HTTPAdapter
+from time import monotonic, sleep, time
 from urllib.parse import quote
 
+import archive
+import asyncio
 import db
 import json
 import os
 import requests
+import rollups
 import shelve
 import sys
 
@@ -18,6 +23,8 @@ argparser = ArgumentParser(description='''
   Fetch tweets that match a query, and add them to db/tweets.
 ''')
 
+API_URL = 'https://api.twitter.com'
+
 defaultargs = {}
 configpath = Path('db/config.json')
 try:
@@ -43,17 +50,26 @@ argparser.add_argument('-total', default=argdef('total'), type=int,
   help='total number of tweets to fetch')
 argparser.add_argument('-delay', default=argdef('delay'), type=float,
   help='delay between batches, in seconds')
+argparser.add_argument('-j', '--jobs', default=argdef('jobs'), type=int,
+  help='fetch up to this many author groups concurrently')
 argparser.add_argument('-r', '--refetch', action='store_true',
   help='refetch tweets even if we have them')
+argparser.add_argument('-api', default=argdef('api') or API_URL,
+  help='base url of the api; see fake_twitter.py for a local stand-in')
+argparser.add_argument('-A', '--no-archive', action='store_true',
+  help='do not keep the fetched pages in db/archive')
 argparser.add_argument('-verbose', action='store_true')
 argparser.add_argument('-d', '--debug', action='store_true',
   help='print to stderr how tweets are parsed')
 
-SEARCH_API_URL = 'https://api.twitter.com/1.1/search/tweets.json'
+SEARCH_API_PATH = '/1.1/search/tweets.json'
 verbose = None
 
 args = None
 
+# the archive.Writer for fetched pages, unless -A
+pages = None
+
 # used (rarely) for flow control
 class Done(BaseException):
   pass
@@ -62,14 +78,8 @@ class NoNewResults(BaseException):
 
 oauth2_headers = None
 
-last_get = None
-def get(url, delay):
+def auth_headers():
   global oauth2_headers
-  global last_get
-  if last_get:
-    sleep(max(0, time() - delay - last_get))
-  if False:
-    print('GET ', url)
   if oauth2_headers is None:
     with open('secret.credentials') as f:
       for line in f:
@@ -80,11 +90,101 @@ def get(url, delay):
   if oauth2_headers is None:
     sys.stderr.write('Please run oauth.py\n')
     raise NoNewResults
-  r = requests.get(url, headers=oauth2_headers)
-  if verbose and 'x-rate-limit-remaining' in r.headers:
-    sys.stderr.write('api-rate-limit-remaining {}\n'.format(r.headers['x-rate-limit-remaining']))
-  last_get = time()
-  return r.json()
+  return oauth2_headers
+
+last_get = None
+def get(url, delay):
+  global last_get
+  for attempt in range(RETRIES):
+    if last_get:
+      sleep(max(0, last_get + delay - time()))
+    if False:
+      print('GET ', url)
+    r = requests.get(url, headers=auth_headers())
+    if verbose and 'x-rate-limit-remaining' in r.headers:
+      sys.stderr.write('api-rate-limit-remaining {}\n'.format(r.headers['x-rate-limit-remaining']))
+    last_get = time()
+    if not should_retry(r, attempt):
+      break
+    sleep(retry_delay(r, attempt))
+  return page_of_response(r)
+
+# Responses 429 (rate limited) and 5xx are retried, a few times.
+RETRIES = 3
+
+def should_retry(r, attempt):
+  if r.status_code != 429 and r.status_code < 500:
+    return False
+  sys.stderr.write('W: api returned {}\n'.format(r.status_code))
+  return attempt + 1 < RETRIES
+
+def retry_delay(r, attempt):
+  if r.status_code == 429 and 'x-rate-limit-reset' in r.headers:
+    return max(1, int(r.headers['x-rate-limit-reset']) - time())
+  return 2 ** attempt
+
+def page_of_response(r):
+  try:
+    page = r.json()
+  except ValueError:
+    page = {}
+  if r.status_code != 200 or 'statuses' not in page:
+    sys.stderr.write('W: api error {}: {}\n'.format(r.status_code,
+      page.get('errors', r.text[:200])))
+    raise NoNewResults
+  return page
+
+
+# Token bucket shared by all concurrent requests. It starts at one request
+# per -delay seconds; after each response, the calls left in the rate-limit
+# window are spread evenly until the window resets.
+class RateBudget:
+  def __init__(self, delay, burst):
+    self.rate = 1 / delay if delay else 1.0
+    self.max_burst = burst
+    self.burst = 1.0
+    self.tokens = 1.0
+    self.stamp = monotonic()
+
+  def refill(self):
+    now = monotonic()
+    self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+    self.stamp = now
+
+  async def acquire(self):
+    while True:
+      self.refill()
+      if self.tokens >= 1:
+        self.tokens -= 1
+        return
+      await asyncio.sleep((1 - self.tokens) / self.rate)
+
+  def update(self, headers):
+    if 'x-rate-limit-remaining' not in headers:
+      return
+    if 'x-rate-limit-reset' not in headers:
+      return
+    remaining = int(headers['x-rate-limit-remaining'])
+    window = max(1.0, int(headers['x-rate-limit-reset']) - time())
+    self.refill()
+    self.rate = max(1, remaining) / window
+    self.burst = max(1.0, min(remaining, self.max_burst))
+    self.tokens = min(self.tokens, remaining)
+
+
+async def aget(session, executor, budget, url):
+  loop = asyncio.get_running_loop()
+  get = partial(session.get, url, headers=auth_headers())
+  for attempt in range(RETRIES):
+    await budget.acquire()
+    r = await loop.run_in_executor(executor, get)
+    budget.update(r.headers)
+    if verbose and 'x-rate-limit-remaining' in r.headers:
+      sys.stderr.write('api-rate-limit-remaining {}\n'.format(r.headers['x-rate-limit-remaining']))
+    if not should_retry(r, attempt):
+      break
+    await asyncio.sleep(retry_delay(r, attempt))
+  return page_of_response(r)
 
 
 def build_query(q, geocode, count, authors):
@@ -104,56 +204,77 @@ def build_query(q, geocode, count, authors):
   return query
 
 
-def time_of_raw_tweet(t):
-  assert 'created_at' in t
-  return timegm(strptime(t['created_at'], '%a %b %d %H:%M:%S +0000 %Y'))
+# Turns fetched pages into db/users and db/tweets as they arrive. Users are
+# remembered for the whole run, so each is looked up in db/users at most
+# once, and written only if its screen name changed. Writes are collected
+# and done in bulk once per batch (a page, or one group when fetching
+# concurrently).
+class Postprocessor:
+  def __init__(self, tweets, users, buckets):
+    self.tweets = tweets
+    self.users = users
+    self.buckets = buckets
+    self.screen_name = {}
+    self.new_users = {}
+    self.new_tweets = []
+    self.written = 0
+
+  def add(self, statuses):
+    for t in statuses:
+      for i, name in db.users_of_status(t):
+        if i not in self.screen_name:
+          old = self.users.get(i)
+          self.screen_name[i] = old.screen_name if old else None
+        if self.screen_name[i] != name:
+          self.screen_name[i] = name
+          self.new_users[i] = db.User(name)
+      parsed = db.tweet_of_status(t)
+      self.new_tweets.append((t['id_str'], parsed))
+      if args.debug:
+        json.dump({'in':t, 'out':parsed.as_dict()}, sys.stderr)
+        sys.stderr.write('\n')
 
+  def flush(self):
+    self.users.update(self.new_users)
+    self.tweets.update(self.new_tweets)
+    rollups.add(self.buckets, self.new_tweets)
+    self.written += len(self.new_tweets)
+    self.new_users = {}
+    self.new_tweets = []
 
+def open_postprocessor():
+  tweets = db.open_tweets('tweets')
+  users = db.open_map('users')
+  buckets = db.open_map('rollups')
+  return Postprocessor(tweets, users, buckets)
+
+def close_postprocessor(pp):
+  pp.flush()
+  pp.buckets.close()
+  pp.users.close()
+  pp.tweets.close()
+  if pp.written:
+    # Screen names, or tweets of a virtual slice, may have changed.
+    db.touch_slice()
+
+# db/raw is where older versions kept fetched tweets until postprocessing;
+# pick up whatever a failed run left there.
 def postprocess_raw_tweets():
+  if not db.shelve_exists('raw'):
+    return
+  pp = open_postprocessor()
   with shelve.open('db/raw') as raw:
-    # Update users.
-    with shelve.open('db/users') as users:
-      for t in raw.values():
-        u = t['user']
-        users[u['id_str']] = db.User(u['screen_name'])
-        for u in t['entities']['user_mentions']:
-          users[u['id_str']] = db.User(u['screen_name'])
-        if t['in_reply_to_user_id_str']:
-          if t['in_reply_to_screen_name']:
-            users[t['in_reply_to_user_id_str']] = db.User(t['in_reply_to_screen_name'])
-
-    # Update tweets.
-    with shelve.open('db/tweets') as tweets:
-      for i, t in raw.items():
-        if not args.refetch and i in tweets:
-          sys.stderr.write('W: tweet {} already in db\n'.format(i))
-        else:
-          text = t['text']
-          time = time_of_raw_tweet(t)
-          author = t['user']['id_str']
-          mention = db.Mention()
-          for u in t['entities']['user_mentions']:
-            mention.users.add(u['id_str'])
-          if t['in_reply_to_user_id_str']:
-            mention.users.add(t['in_reply_to_user_id_str'])
-          for u in t['entities']['urls']:
-            mention.urls.add(u['expanded_url'])
-          if 'retweeted_status' in t:
-            mention.tweets.add(t['retweeted_status']['id_str'])
-            mention.users.add(t['retweeted_status']['user']['id_str'])
-            for u in t['retweeted_status']['entities']['urls']:
-              mention.urls.add(u['expanded_url'])
-          if 'quoted_status' in t:
-            mention.tweets.add(t['quoted_status']['id_str'])
-            mention.users.add(t['quoted_status']['user']['id_str'])
-            for u in t['quoted_status']['entities']['urls']:
-              mention.urls.add(u['expanded_url'])
-          parsed = db.Tweet(text, time, author, mention)
-          tweets[i] = parsed
-          if args.debug:
-            json.dump({'in':t, 'out':parsed.as_dict()}, sys.stderr)
-            sys.stderr.write('\n')
-  os.remove('db/raw')
+    batch = []
+    for i, t in raw.items():
+      if not args.refetch and i in pp.tweets:
+        sys.stderr.write('W: tweet {} already in db\n'.format(i))
+      else:
+        batch.append(t)
+    pp.add(batch)
+  close_postprocessor(pp)
+  for suffix in db.SHELVE_SUFFIXES:
+    if os.path.exists('db/raw' + suffix):
+      os.remove('db/raw' + suffix)
 
 bad_times = False
 def check_times(tweets):
@@ -164,17 +285,116 @@ def check_times(tweets):
   bad = False
   for t in tweets:
     if p is None:
-      p = time_of_raw_tweet(t)
+      p = db.time_of_raw_tweet(t)
     else:
-      n = time_of_raw_tweet(t)
+      n = db.time_of_raw_tweet(t)
       if p < n:
         bad_times = True
         sys.stderr.write('W: tweet times are not ordered\n')
 
 
+def archive_page(page):
+  if pages and 'statuses' in page:
+    pages.append(page['statuses'])
+
+def fetch_sequentially():
+  postprocess_raw_tweets()
+  pp = open_postprocessor()
+  try:
+    for authors in args.authors:
+      fetch_group_sequentially(pp, authors)
+  finally:
+    close_postprocessor(pp)
+
+def fetch_group_sequentially(pp, authors):
+  processed = 0
+  sys.stderr.write('fetching {} from {}\n'.format(args.total, ' '.join(authors)))
+  query = build_query(args.q, args.geocode, args.count, authors)
+  try:
+    page = get('{}{}{}'.format(args.api, SEARCH_API_PATH, query), args.delay)
+    while True:
+      archive_page(page)
+      check_times(page['statuses'])
+      try:
+        for s in page['statuses']:
+          if not args.refetch and s['id_str'] in pp.tweets:
+            raise Done # assumes that times are descending
+          pp.add([s])
+          processed += 1
+          if args.total and processed >= args.total:
+            raise Done
+      finally:
+        pp.flush()
+      sys.stderr.write('fetched {} tweets\n'.format(processed))
+      if 'next_results' not in page['search_metadata']:
+        if not args.refetch:
+          sys.stderr.write('W: gap in tweet data; run me more often\n')
+        raise Done
+      query = page['search_metadata']['next_results']
+      page = get('{}{}{}'.format(args.api, SEARCH_API_PATH, query), args.delay)
+  except Done:
+    sys.stderr.write('fetched {} tweets (DONE)\n'.format(processed))
+  except NoNewResults:
+    sys.stderr.write('no tweets to fetch\n')
+
+
+# Same as fetch_group_sequentially, but returns the statuses instead of
+# writing them, so that concurrent groups are written one at a time.
+async def fetch_group(session, executor, budget, tweets, authors):
+  processed = 0
+  statuses = []
+  name = ' '.join(authors)
+  query = build_query(args.q, args.geocode, args.count, authors)
+  try:
+    page = await aget(session, executor, budget, '{}{}{}'.format(args.api, SEARCH_API_PATH, query))
+    while True:
+      archive_page(page)
+      check_times(page['statuses'])
+      for s in page['statuses']:
+        if not args.refetch and s['id_str'] in tweets:
+          raise Done # assumes that times are descending
+        statuses.append(s)
+        processed += 1
+        if args.total and processed >= args.total:
+          raise Done
+      if verbose:
+        sys.stderr.write('fetched {} tweets from {}\n'.format(processed, name))
+      if 'next_results' not in page['search_metadata']:
+        if not args.refetch:
+          sys.stderr.write('W: gap in tweet data for {}; run me more often\n'.format(name))
+        raise Done
+      query = page['search_metadata']['next_results']
+      page = await aget(session, executor, budget, '{}{}{}'.format(args.api, SEARCH_API_PATH, query))
+  except Done:
+    sys.stderr.write('fetched {} tweets from {} (DONE)\n'.format(processed, name))
+  except NoNewResults:
+    sys.stderr.write('no tweets to fetch from {}\n'.format(name))
+  return statuses
+
+async def fetch_concurrently():
+  postprocess_raw_tweets()
+  budget = RateBudget(args.delay, args.jobs)
+  pp = open_postprocessor()
+  try:
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+      with requests.Session() as session:
+        for scheme in ['http://', 'https://']:
+          session.mount(scheme, HTTPAdapter(pool_maxsize=args.jobs))
+        # Groups run concurrently, but their pages are stored in group order.
+        groups = [asyncio.ensure_future(
+            fetch_group(session, executor, budget, pp.tweets, authors))
+          for authors in args.authors]
+        for group in groups:
+          pp.add(await group)
+          pp.flush()
+  finally:
+    close_postprocessor(pp)
+
+
 def main():
   global args
   global verbose
+  global pages
   args = argparser.parse_args()
   verbose = args.verbose
   if not args.authors:
@@ -182,37 +402,16 @@ def main():
   else:
     args.authors = [args.authors[i:i+5] for i in range(0,len(args.authors),5)]
   args.total = 1 + args.total // len(args.authors)
-  for authors in args.authors:
-    processed = 0
-    sys.stderr.write('fetching {} from {}\n'.format(args.total, ' '.join(authors)))
-    query = build_query(args.q, args.geocode, args.count, authors)
-    try:
-      with shelve.open('db/tweets') as tweets:
-        with shelve.open('db/raw') as raw:
-          page = get('{}{}'.format(SEARCH_API_URL, query), args.delay)
-          while True:
-            check_times(page['statuses'])
-            for s in page['statuses']:
-              if not args.refetch and s['id_str'] in tweets:
-                raise Done # assumes that times are descending
-              raw[s['id_str']] = s
-              processed += 1
-              if args.total and processed >= args.total:
-                raise Done
-            raw.sync()
-            sys.stderr.write('fetched {} tweets\n'.format(processed))
-            if 'next_results' not in page['search_metadata']:
-              if not args.refetch:
-                sys.stderr.write('W: gap in tweet data; run me more often\n')
-              raise Done
-            query = page['search_metadata']['next_results']
-            page = get('{}{}'.format(SEARCH_API_URL, query), args.delay)
-    except Done:
-      sys.stderr.write('fetched {} tweets (DONE)\n'.format(processed))
-    except NoNewResults:
-      sys.stderr.write('no tweets to fetch\n')
-    postprocess_raw_tweets()
+  if not args.no_archive:
+    pages = archive.Writer()
+  try:
+    if args.jobs and args.jobs > 1:
+      asyncio.run(fetch_concurrently())
+    else:
+      fetch_sequentially()
+  finally:
+    if pages:
+      pages.close()
 
 if __name__ == '__main__':
   main()
-
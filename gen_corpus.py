@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from contextlib import closing
+from pathlib import Path
+
+import db
+import shelve
+import sys
+import synthetic
+
+argparser = ArgumentParser(description='''
+  Fill db/tweets and db/users with a synthetic corpus (see synthetic.py),
+  replacing what is there: a power-law mention graph, urls reused by many
+  tweets, and Romanian text with diacritics. With -l, also write the corpus
+  in the statuses/ layout that stats.py reads.
+''')
+
+argparser.add_argument('-n', '--size', default=10000, type=int,
+  help='how many tweets')
+argparser.add_argument('-s', '--seed', default=0, type=int,
+  help='seed of the corpus')
+argparser.add_argument('-u', '--url-base', default='http://example.com',
+  help='urls in tweets start with this, e.g. http://localhost:8080/r/2 '
+  'to have fake_twitter.py redirect them twice')
+argparser.add_argument('-l', '--legacy', action='store_true',
+  help='also write statuses/data, statuses/index and statuses/indexsize')
+
+def write_db(corpus):
+  with db.open_map('users', 'n') as users:
+    users.update((str(u + 1), db.User(corpus.user(u)['screen_name']))
+      for u in range(corpus.users))
+  with db.open_tweets('tweets', 'n') as tweets:
+    def parsed():
+      for k in range(corpus.size):
+        s = corpus.status(k)
+        yield s['id_str'], db.tweet_of_status(s)
+        if k % 100000 == 99999:
+          sys.stderr.write('  {} tweets\n'.format(k + 1))
+    tweets.update(parsed())
+  db.remove_slice_manifest()
+  db.touch_slice()
+
+# statuses/index lists the ids by position, oldest first.
+def write_legacy(corpus):
+  Path('statuses').mkdir(exist_ok=True)
+  with closing(shelve.open('statuses/data', 'n')) as data:
+    with closing(shelve.open('statuses/index', 'n')) as index:
+      for p in range(corpus.size):
+        s = corpus.status(corpus.size - 1 - p)
+        data[s['id_str']] = {'time': db.time_of_raw_tweet(s),
+          'user': s['user']['screen_name'], 'text': s['text']}
+        index[str(p)] = s['id_str']
+  with open('statuses/indexsize', 'w') as f:
+    f.write('{}\n'.format(corpus.size))
+
+def main():
+  args = argparser.parse_args()
+  corpus = synthetic.Corpus(args.size, seed=args.seed, url_base=args.url_base)
+  write_db(corpus)
+  if args.legacy:
+    write_legacy(corpus)
+  sys.stderr.write('wrote {} tweets by {} users, with {} urls, from {} to {}\n'
+    .format(corpus.size, corpus.users, corpus.urls, corpus.oldest(),
+      corpus.start))
+
+if __name__ == '__main__':
+  main()
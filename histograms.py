@@ -0,0 +1,155 @@
+'''Per-user histograms of words, urls and mentions, in columns.
+
+A store is a directory, histograms.d by default. vocabulary.json has the
+sorted lists of users, words and urls; a user, word or url is then known by
+its position in its list. For each of the KINDS there is a file KIND.csr
+with a HEADER and three arrays, as in a compressed sparse row matrix with a
+row per user: row u has the term ids ids[start[u]:start[u+1]], with their
+counts next to them. Mentions are of users, so their ids are user ids. The
+arrays are mapped into memory, not read, and a row is only turned into
+Python objects when it is asked for.
+'''
+
+from array import array
+from pathlib import Path
+
+import json
+import mmap
+import shutil
+import struct
+
+DIRECTORY = Path('histograms.d')
+KINDS = ['words', 'urls', 'mentions']
+VOCABULARY_OF_KIND = {'words': 'words', 'urls': 'urls', 'mentions': 'users'}
+HEADER = struct.Struct('<8sQQ')
+MAGIC = b'HISTCSR1'
+
+def write(histograms_of_user, directory=DIRECTORY):
+  '''Replace the store with the given histograms.
+
+  histograms_of_user maps each user to a dictionary from each of the KINDS
+  to a dictionary from terms to counts.'''
+  users = set(histograms_of_user)
+  for h in histograms_of_user.values():
+    users.update(h.get('mentions', ()))
+  vocabulary = {'users': sorted(users)}
+  for kind in ('words', 'urls'):
+    terms = set()
+    for h in histograms_of_user.values():
+      terms.update(h.get(kind, ()))
+    vocabulary[kind] = sorted(terms)
+  tmp = directory.with_name(directory.name + '.tmp')
+  shutil.rmtree(str(tmp), ignore_errors=True)
+  tmp.mkdir()
+  with (tmp / 'vocabulary.json').open('w') as f:
+    json.dump(vocabulary, f, ensure_ascii=False)
+  for kind in KINDS:
+    id_of = dict((t, i)
+      for i, t in enumerate(vocabulary[VOCABULARY_OF_KIND[kind]]))
+    start, ids, counts = array('Q', [0]), array('I'), array('I')
+    for u in vocabulary['users']:
+      row = sorted((id_of[t], c)
+        for t, c in histograms_of_user.get(u, {}).get(kind, {}).items())
+      ids.extend(i for i, _ in row)
+      counts.extend(c for _, c in row)
+      start.append(len(ids))
+    with (tmp / (kind + '.csr')).open('wb') as f:
+      f.write(HEADER.pack(MAGIC, len(vocabulary['users']), len(ids)))
+      start.tofile(f)
+      ids.tofile(f)
+      counts.tofile(f)
+  shutil.rmtree(str(directory), ignore_errors=True)
+  tmp.replace(directory)
+
+class Table:
+  '''The histograms of one kind, a row per user.'''
+  def __init__(self, path, terms):
+    self.terms = terms
+    with path.open('rb') as f:
+      self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, self.rows, nnz = HEADER.unpack_from(self.map)
+    if magic != MAGIC:
+      self.map.close()
+      raise ValueError('{} is not a histogram table'.format(path))
+    view = memoryview(self.map)
+    a = HEADER.size
+    b = a + 8 * (self.rows + 1)
+    c = b + 4 * nnz
+    self.start = view[a:b].cast('Q')
+    self.ids = view[b:c].cast('I')
+    self.counts = view[c:c + 4 * nnz].cast('I')
+    view.release()
+
+  def close(self):
+    for v in (self.start, self.ids, self.counts):
+      v.release()
+    self.map.close()
+
+  def __len__(self):
+    return self.rows
+
+  def row(self, u):
+    '''The term ids and the counts of user u.'''
+    a, b = self.start[u], self.start[u + 1]
+    return self.ids[a:b], self.counts[a:b]
+
+  def __getitem__(self, u):
+    '''The histogram of user u, as a dictionary from terms to counts.'''
+    ids, counts = self.row(u)
+    return dict((self.terms[i], c) for i, c in zip(ids, counts))
+
+  def totals(self):
+    '''The count of each term, over all users, as a list by term id.'''
+    try:
+      import numpy as np
+    except ImportError:
+      total = [0] * len(self.terms)
+      for i, c in zip(self.ids, self.counts):
+        total[i] += c
+      return total
+    return np.bincount(np.frombuffer(self.ids, dtype=np.uint32),
+      weights=np.frombuffer(self.counts, dtype=np.uint32),
+      minlength=len(self.terms)).astype(np.int64).tolist()
+
+  def distribute(self, weight):
+    '''Split weight[u] among the terms of user u, in proportion to their
+    counts; the share of each term, summed over users, by term id.'''
+    try:
+      import numpy as np
+    except ImportError:
+      total = [0.0] * len(self.terms)
+      for u in range(self.rows):
+        ids, counts = self.row(u)
+        tw = sum(counts)
+        for i, c in zip(ids, counts):
+          total[i] += weight[u] * c / tw
+      return total
+    start = np.frombuffer(self.start, dtype=np.uint64).astype(np.int64)
+    owner = np.repeat(np.arange(self.rows), np.diff(start))
+    counts = np.frombuffer(self.counts, dtype=np.uint32).astype(np.float64)
+    tw = np.bincount(owner, weights=counts, minlength=self.rows)
+    share = np.asarray(weight, dtype=np.float64)[owner] * counts / tw[owner]
+    return np.bincount(np.frombuffer(self.ids, dtype=np.uint32), weights=share,
+      minlength=len(self.terms)).tolist()
+
+class Store:
+  def __init__(self, directory=DIRECTORY):
+    with (directory / 'vocabulary.json').open() as f:
+      self.vocabulary = json.load(f)
+    self.users = self.vocabulary['users']
+    self.tables = {}
+    for kind in KINDS:
+      self.tables[kind] = Table(directory / (kind + '.csr'),
+        self.vocabulary[VOCABULARY_OF_KIND[kind]])
+
+  def __enter__(self):
+    return self
+  def __exit__(self, *exc):
+    self.close()
+
+  def close(self):
+    for t in self.tables.values():
+      t.close()
+
+  def __getitem__(self, kind):
+    return self.tables[kind]
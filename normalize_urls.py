@@ -1,87 +1,213 @@
 #!/usr/bin/env python3
 
 from argparse import ArgumentParser
-from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from urllib.parse import urlsplit, urlunsplit
 from util import phase
 
+import asyncio
+import db
 import requests
-import shelve
 import sys
+import threading
 
 argparser = ArgumentParser(description='''
   Changes db/slice to use normalized urls.
 
-  The urls are normalized by following redirects. The result is cached in
-  db/urls, to speed up future calls.
+  The urls are first canonicalized offline (tracking parameters, host case,
+  default ports, fragments, known aliases), and then normalized by following
+  redirects. The result is cached in db/urls, to speed up future calls;
+  failures are cached too, for --negative-ttl seconds. If db/slice is
+  virtual, the tweets are changed in db/tweets.
 ''')
 
 argparser.add_argument('-n', '--nproc', default=100, type=int,
-  help='how many processes/http-requests to run in parallel')
+  help='how many http-requests to run in parallel')
+argparser.add_argument('-p', '--perhost', default=4, type=int,
+  help='how many http-requests to run in parallel against one host')
 argparser.add_argument('-t', '--timeout', default=10, type=float,
   help='timeout for each url request')
+argparser.add_argument('--ttl', default=0, type=float,
+  help='seconds after which resolved urls are looked up again (0 = never)')
+argparser.add_argument('--negative-ttl', default=24*60*60, type=float,
+  help='seconds after which failed urls are looked up again')
+argparser.add_argument('-a', '--all', action='store_true',
+  help='also look at tweets that were already normalized')
 
-def get_all_urls():
-  urls = set()
-  with shelve.open('db/slice') as tweets:
-    for t in tweets.values():
-      urls.update(t.mention.urls)
-  phase('todo {} urls'.format(len(urls)))
-  return urls
-
-normalize_timeout = None
-def normalize_one(u):
-  global normalize_timeout
+# Tweets are marked with the cache version their urls were normalized
+# against (db.Tweet.norm), and skipped while it is current. Bump this when
+# the canonical forms change.
+CACHE_VERSION = 1
+
+TRACKING_PARAMETERS = {'fbclid', 'gclid', 'dclid', 'igshid', 'mc_cid',
+  'mc_eid', 'ref_src', 'ref_url', 'yclid', '_hsenc', '_hsmi'}
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+# host -> canonical host, for mirrors that serve the same pages
+HOST_ALIASES = {
+  'mobile.twitter.com': 'twitter.com',
+  'www.twitter.com': 'twitter.com',
+  'm.youtube.com': 'www.youtube.com',
+  'youtube.com': 'www.youtube.com',
+  'm.facebook.com': 'www.facebook.com',
+  'facebook.com': 'www.facebook.com' }
+
+def canonicalize_url(u):
+  '''Offline clean-up, done before (and after) following redirects.'''
   try:
-    un = requests.head(u, allow_redirects=True, timeout=normalize_timeout).url
-  except Exception as e:
-    print(e)
-    un = None
-  return (u, un)
-
-def normalize_all(urls, nproc, timeout):
-  global normalize_timeout
-  normalize_timeout = timeout
-  norm = {}
-  todo = []
-  with shelve.open('db/urls') as cache:
-    for u in urls:
-      if u in cache:
-        norm[u] = cache[u]
-      else:
-        todo.append(u)
-  phase('todo {} urls online'.format(len(todo)))
-  with ProcessPoolExecutor(max_workers=nproc) as executor:
-    for u, un in executor.map(normalize_one, todo, chunksize=10):
+    parts = urlsplit(u.strip())
+    port = parts.port
+  except ValueError:
+    return u
+  scheme = parts.scheme.lower()
+  host = (parts.hostname or '').rstrip('.')
+  if host.endswith('.m.wikipedia.org'):
+    host = host[:-len('.m.wikipedia.org')] + '.wikipedia.org'
+  host = HOST_ALIASES.get(host, host)
+  if ':' in host:
+    host = '[' + host + ']'
+  path = parts.path or '/'
+  # Parameters are kept as they are, not decoded and re-encoded.
+  query = [p for p in parts.query.split('&') if p]
+  query = [p for p in query
+    if not p.startswith('utm_') and p.split('=', 1)[0] not in TRACKING_PARAMETERS]
+  if host == 'youtu.be' and len(path) > 1:
+    host, query = 'www.youtube.com', ['v=' + path[1:]] + query
+    path = '/watch'
+  netloc = host
+  if parts.username or parts.password:
+    netloc = parts.netloc.rsplit('@', 1)[0] + '@' + netloc
+  if port is not None and port != DEFAULT_PORTS.get(scheme):
+    netloc += ':{}'.format(port)
+  return urlunsplit((scheme, netloc, path, '&'.join(query), ''))
+
+# Entries in db/urls are (normalized url or None, time of lookup). Entries
+# from older versions are bare urls, and never expire.
+def cache_lookup(cache, u, now, ttl, negative_ttl):
+  if u not in cache:
+    return None
+  entry = cache[u]
+  if isinstance(entry, str):
+    return (entry,)
+  un, stamp = entry
+  if un is None:
+    return (None,) if now - stamp < negative_ttl else None
+  return (un,) if not ttl or now - stamp < ttl else None
+
+def get_stale_urls(everything):
+  '''Returns a map from urls to the ids of the tweets that mention them.'''
+  tweets_of_url = defaultdict(list)
+  version = CACHE_VERSION + 1 if everything else CACHE_VERSION
+  with db.open_slice() as tweets:
+    for i, u in tweets.stale_urls(version):
+      tweets_of_url[u].append(i)
+  phase('todo {} urls'.format(len(tweets_of_url)))
+  return tweets_of_url
+
+# Each worker thread keeps its own session, so connections to a host are
+# reused across urls.
+session_of_thread = threading.local()
+def normalize_one(u, timeout):
+  if not hasattr(session_of_thread, 'session'):
+    session_of_thread.session = requests.Session()
+  return session_of_thread.session.head(u, allow_redirects=True, timeout=timeout).url
+
+async def resolve_all(todo, nproc, perhost, timeout, cache, norm):
+  loop = asyncio.get_running_loop()
+  limit = asyncio.Semaphore(nproc)
+  host_limit = defaultdict(lambda: asyncio.Semaphore(perhost))
+  async def resolve(u):
+    # Wait for the host first, so slow hosts don't hold global slots.
+    async with host_limit[urlsplit(u).netloc.lower()]:
+      async with limit:
+        try:
+          un = await loop.run_in_executor(executor, normalize_one, u, timeout)
+        except Exception as e:
+          print(e)
+          un = None
+    return (u, un)
+  with ThreadPoolExecutor(max_workers=nproc) as executor:
+    done = 0
+    for r in asyncio.as_completed([resolve(u) for u in todo]):
+      u, un = await r
+      done += 1
+      now = time()
       if un is not None:
+        un = canonicalize_url(un)
         norm[u] = un
-  phase('finished http requests')
+        # Normalized urls normalize to themselves; saves a lookup if they
+        # show up again.
+        if un != u and un not in cache:
+          cache[un] = (un, now)
+      cache[u] = (un, now)
+      if done % 1000 == 0:
+        cache.sync()
+        phase('resolved {} of {} urls'.format(done, len(todo)))
 
-  with shelve.open('db/slice') as tweets:
-    for i in list(tweets.keys()):
-      t = tweets[i]
-      new_urls = set()
-      for u in t.mention.urls:
-        if u in norm:
-          new_urls.add(norm[u])
-        else:
-          new_urls.add(u)
-      t.mention.urls = new_urls
-      tweets[i] = t
-  phase('updated db/slice')
+def normalize_all(urls, nproc, perhost, timeout, ttl, negative_ttl):
+  '''Returns the normalized form of urls, and the urls that failed.'''
+  norm = {}
+  canonical = {u: canonicalize_url(u) for u in urls}
+  distinct = set(canonical.values())
+  phase('canonicalized; {} distinct urls left'.format(len(distinct)))
+  with db.open_map('urls') as cache:
+    todo = set()
+    now = time()
+    for c in distinct:
+      hit = cache_lookup(cache, c, now, ttl, negative_ttl)
+      if hit is None:
+        todo.add(c)
+      elif hit[0] is not None:
+        norm[c] = hit[0]
+    phase('todo {} urls online'.format(len(todo)))
+    asyncio.run(resolve_all(todo, nproc, perhost, timeout, cache, norm))
+  phase('finished http requests; updated cache db/urls')
+  failed = set(u for u, c in canonical.items() if c not in norm)
+  for u, c in canonical.items():
+    norm[u] = norm.get(c, c)
+  return norm, failed
 
-  return norm
+def rewrite_slice(tweets_of_url, norm, failed):
+  '''Writes back only the tweets whose urls change.
 
-def save(norm):
-  with shelve.open('db/urls') as cache:
-    for k, v in norm.items():
-      cache[k] = v
-  phase('updated cache db/urls')
+  Tweets are marked as normalized unless one of their urls failed, so
+  that those are retried once the negative cache expires.'''
+  changed = set()
+  unfinished = set()
+  for u, ids in tweets_of_url.items():
+    if u in failed:
+      unfinished.update(ids)
+    if norm[u] != u:
+      changed.update(ids)
+  with db.open_slice() as tweets:
+    updated = []
+    for i in changed:
+      t = tweets[i]
+      new_urls = tuple(sorted(set(norm.get(u, u) for u in t.mention.urls)))
+      if new_urls == t.mention.urls:
+        continue
+      t.mention.urls = new_urls
+      if i not in unfinished:
+        t.norm = CACHE_VERSION
+      updated.append((i, t))
+    tweets.update(updated)
+    done = set()
+    for ids in tweets_of_url.values():
+      done.update(ids)
+    done -= unfinished
+    done -= set(i for i, _ in updated)
+    tweets.mark_normalized(done, CACHE_VERSION)
+  if updated:
+    db.touch_slice()
+  phase('updated {} tweets in db/slice'.format(len(updated)))
 
 def main():
   args = argparser.parse_args()
-  urls = get_all_urls()
-  norm = normalize_all(urls, args.nproc, args.timeout)
-  save(norm)
+  tweets_of_url = get_stale_urls(args.all)
+  norm, failed = normalize_all(tweets_of_url.keys(), args.nproc, args.perhost,
+    args.timeout, args.ttl, args.negative_ttl)
+  rewrite_slice(tweets_of_url, norm, failed)
 
 if __name__ == '__main__':
   main()
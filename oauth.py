@@ -1,12 +1,23 @@
 #!/usr/bin/env python3
 
+from argparse import ArgumentParser
 from base64 import b64encode
 
 import requests
+import sys
 
-URL = 'https://api.twitter.com/oauth2/token'
+argparser = ArgumentParser(description='''
+  Get an access token for the consumer key and secret in
+  secret.credentials, and store it there.
+''')
 
-def login():
+API_URL = 'https://api.twitter.com'
+TOKEN_PATH = '/oauth2/token'
+
+argparser.add_argument('-api', default=API_URL,
+  help='base url of the api; see fake_twitter.py for a local stand-in')
+
+def login(api=API_URL):
   secrets = {}
   with open('secret.credentials') as f:
     for line in f:
@@ -21,7 +32,7 @@ def login():
     { 'Authorization' : 'Basic {}'.format(str(key, encoding='utf8'))
     , 'Content-Type' : 'application/x-www-form-urlencoded;charset=UTF-8' }
   data = 'grant_type=client_credentials'
-  r = requests.post(URL, data=data, headers=headers).json()
+  r = requests.post(api + TOKEN_PATH, data=data, headers=headers).json()
   if r['token_type'] != 'bearer':
     sys.stderr.write('cannot understand login reply: {}\n'.format(r))
     return
@@ -32,4 +43,4 @@ def login():
       f.write('{} {}\n'.format(k, v))
 
 if __name__ == '__main__':
-  login()
+  login(argparser.parse_args().api)
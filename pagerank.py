@@ -0,0 +1,415 @@
+'''Solvers for the pagerank fixpoint x = Px, shared by rank_users.py and
+cluster.py, and personalized pagerank for queries around a few users.
+
+The graph is given by its arcs: arc k goes from src[k] to dst[k] with weight
+w[k], and the weights out of each node sum to 1, so that the total score is
+preserved. The residual of an iteration is the largest change of a score.
+'''
+
+from bisect import bisect_left, bisect_right
+from collections import deque, namedtuple
+from importlib.util import find_spec
+from itertools import islice
+from time import perf_counter
+
+import sys
+
+Graph = namedtuple('Graph', 'n src dst w')
+
+METHODS = ['power', 'gauss-seidel', 'aitken', 'push']
+
+def have_numpy():
+  return find_spec('numpy') is not None
+
+class Trace:
+  '''Per-iteration residuals, optionally written to a file as they come.'''
+  def __init__(self, method, path=None):
+    self.method = method
+    self.start = perf_counter()
+    self.rows = []
+    self.out = open(path, 'a') if path else None
+  def __call__(self, iteration, residual):
+    t = perf_counter() - self.start
+    self.rows.append((iteration, t, residual))
+    if self.out:
+      self.out.write('{}\t{}\t{:.6f}\t{:.6g}\n'.format(
+        self.method, iteration, t, residual))
+  def elapsed(self):
+    return perf_counter() - self.start
+  def close(self):
+    if self.out:
+      self.out.close()
+
+def solve(g, method='power', engine='numpy', tol=0.001, budget=None, x0=None,
+    trace_path=None, workers=1):
+  '''Returns (scores, iterations).
+
+  Stops when the residual is at most tol, or after budget seconds. Without
+  x0, all scores start at 1. For push, iterations counts passes over all
+  arcs. More than one worker is supported by the numpy power method only.'''
+  if engine == 'numpy' and not have_numpy():
+    sys.stderr.write('W: no numpy; using the python engine\n')
+    engine = 'python'
+  if workers > 1 and (method, engine) != ('power', 'numpy'):
+    sys.stderr.write('W: only the numpy power method runs in parallel\n')
+    workers = 1
+  trace = Trace(method, trace_path)
+  x0 = list(x0) if x0 else [1.0] * g.n
+  try:
+    if method == 'power' and engine == 'numpy' and workers > 1:
+      return power_parallel(g, x0, tol, budget, trace, workers)
+    elif method == 'power' and engine == 'numpy':
+      return power_numpy(g, x0, tol, budget, trace)
+    elif method == 'power':
+      return power_python(g, x0, tol, budget, trace)
+    elif method == 'gauss-seidel':
+      return gauss_seidel(g, x0, tol, budget, trace)
+    elif method == 'aitken':
+      return aitken(g, x0, tol, budget, trace, engine)
+    elif method == 'push':
+      return push(g, x0, tol, budget, trace, engine)
+    raise ValueError('unknown method {}'.format(method))
+  finally:
+    trace.close()
+
+def out_of_time(trace, budget, iterations):
+  if budget is not None and trace.elapsed() > budget:
+    sys.stderr.write('W: stopping early after {} iterations\n'.format(iterations))
+    return True
+  return False
+
+def step_python(g, now):
+  nxt = [0] * g.n
+  for i, j, f in zip(g.src, g.dst, g.w):
+    nxt[j] += now[i] * f
+  return nxt
+
+# Returns the last iterate before convergence, as the original loop did.
+def power_python(g, x0, tol, budget, trace):
+  n = g.n
+  nxt = x0
+  now = None
+  error = tol + 1
+  iterations = 0
+  while error > tol:
+    iterations += 1
+    now, nxt = nxt, step_python(g, nxt)
+    error = max(abs(now[i]-nxt[i]) for i in range(n))
+    trace(iterations, error)
+    if out_of_time(trace, budget, iterations):
+      break
+  return now, iterations
+
+# Same iteration as power_python, with the arcs as a sparse matrix in
+# coordinate form; bincount does the scatter-add of one matrix-vector
+# product.
+def power_numpy(g, x0, tol, budget, trace):
+  import numpy as np
+  n = g.n
+  src, dst, w = numpy_arcs(g)
+  nxt = np.array(x0, dtype=np.float64)
+  now = None
+  error = tol + 1
+  iterations = 0
+  while error > tol:
+    iterations += 1
+    now = nxt
+    nxt = np.bincount(dst, weights=now[src] * w, minlength=n)
+    error = np.abs(now - nxt).max()
+    trace(iterations, error)
+    if out_of_time(trace, budget, iterations):
+      break
+  return now.tolist(), iterations
+
+def numpy_arcs(g):
+  import numpy as np
+  def column(xs, dtype):
+    try:
+      return np.frombuffer(xs, dtype=dtype)
+    except TypeError:
+      return np.array(xs, dtype=dtype)
+  return column(g.src, np.int64), column(g.dst, np.int64), column(g.w, np.float64)
+
+# Parallel power_numpy. The arcs, sorted by dst, and two score vectors live in
+# one block of shared memory; worker p owns the scores of a range of nodes,
+# chosen so that all workers get about as many arcs. In each iteration the
+# workers read one score vector and write their part of the other, so only
+# the buffer number and the residuals go through the pipes. Sorting by dst is
+# stable, so each score is summed in the same order as in power_numpy, and
+# the results are identical.
+def power_parallel(g, x0, tol, budget, trace, workers):
+  import numpy as np
+  from multiprocessing import Pipe, Process
+  from multiprocessing.shared_memory import SharedMemory
+  n = g.n
+  src, dst, w = numpy_arcs(g)
+  m = len(src)
+  order = np.argsort(dst, kind='stable')
+  shm = SharedMemory(create=True, size=8 * (3 * m + 2 * n))
+  procs, pipes = [], []
+  try:
+    asrc, adst, aw, x = shared_arrays(shm, n, m)
+    asrc[:] = src[order]
+    adst[:] = dst[order]
+    aw[:] = w[order]
+    x[0] = x0
+    del order
+    # node range [lo, hi) of each worker, and its arcs [alo, ahi)
+    cuts = np.searchsorted(adst, np.arange(n + 1))
+    bounds = [0]
+    for p in range(1, workers):
+      bounds.append(max(bounds[-1], int(np.searchsorted(cuts, m * p // workers))))
+    bounds.append(n)
+    for lo, hi in zip(bounds, bounds[1:]):
+      here, there = Pipe()
+      proc = Process(target=power_worker, daemon=True,
+        args=(there, shm.name, n, m, lo, hi, int(cuts[lo]), int(cuts[hi])))
+      proc.start()
+      procs.append(proc)
+      pipes.append(here)
+    del asrc, adst, aw
+    nxt = 0
+    error = tol + 1
+    iterations = 0
+    while error > tol:
+      iterations += 1
+      now, nxt = nxt, 1 - nxt
+      for pipe in pipes:
+        pipe.send(now)
+      error = max(pipe.recv() for pipe in pipes)
+      trace(iterations, error)
+      if out_of_time(trace, budget, iterations):
+        break
+    # x[now] is the vector read in the last iteration, as in power_numpy
+    return x[now].tolist(), iterations
+  finally:
+    for pipe in pipes:
+      pipe.send(None)
+    for proc in procs:
+      proc.join()
+    x = None
+    shm.close()
+    shm.unlink()
+
+def shared_arrays(shm, n, m):
+  import numpy as np
+  asrc = np.ndarray(m, dtype=np.int64, buffer=shm.buf)
+  adst = np.ndarray(m, dtype=np.int64, buffer=shm.buf, offset=8 * m)
+  aw = np.ndarray(m, dtype=np.float64, buffer=shm.buf, offset=16 * m)
+  x = np.ndarray((2, n), dtype=np.float64, buffer=shm.buf, offset=24 * m)
+  return asrc, adst, aw, x
+
+def power_worker(pipe, name, n, m, lo, hi, alo, ahi):
+  import numpy as np
+  from multiprocessing.shared_memory import SharedMemory
+  shm = SharedMemory(name)
+  asrc, adst, aw, x = shared_arrays(shm, n, m)
+  src = asrc[alo:ahi]
+  dst = adst[alo:ahi] - lo
+  w = aw[alo:ahi]
+  while True:
+    now = pipe.recv()
+    if now is None:
+      break
+    nxt = np.bincount(dst, weights=x[now][src] * w, minlength=hi - lo)
+    x[1 - now][lo:hi] = nxt
+    pipe.send(float(np.abs(x[now][lo:hi] - nxt).max()) if hi > lo else 0.0)
+  del asrc, adst, aw, x, src, dst, w
+  shm.close()
+
+# Updates the scores in place, one node at a time, so that later nodes in a
+# sweep already see the new scores of earlier ones; a self-loop is solved for
+# exactly. This does not preserve the total, so each sweep is rescaled.
+def gauss_seidel(g, x0, tol, budget, trace):
+  n = g.n
+  total = sum(x0)
+  arcs_into = [[] for _ in range(n)]
+  loop = [0] * n
+  for i, j, f in zip(g.src, g.dst, g.w):
+    if i != j:
+      arcs_into[j].append((i, f))
+    else:
+      loop[j] += f
+  x = x0
+  error = tol + 1
+  iterations = 0
+  while error > tol:
+    iterations += 1
+    old = list(x)
+    for j in range(n):
+      if loop[j] < 1:
+        x[j] = sum(x[i] * f for i, f in arcs_into[j]) / (1 - loop[j])
+    scale = total / sum(x)
+    for j in range(n):
+      x[j] *= scale
+    error = max(abs(old[j] - x[j]) for j in range(n))
+    trace(iterations, error)
+    if out_of_time(trace, budget, iterations):
+      break
+  return x, iterations
+
+# Power iteration with Aitken extrapolation every `period` iterations: each
+# score is replaced by the limit of the geometric sequence through its last
+# three values, where that is defined and positive.
+def aitken(g, x0, tol, budget, trace, engine, period=10):
+  n = g.n
+  total = sum(x0)
+  if engine == 'numpy':
+    import numpy as np
+    src, dst, w = numpy_arcs(g)
+    step = lambda x: np.bincount(dst, weights=x[src] * w, minlength=n)
+    change = lambda x, y: np.abs(x - y).max()
+    x = np.array(x0, dtype=np.float64)
+  else:
+    step = lambda x: step_python(g, x)
+    change = lambda x, y: max(abs(a - b) for a, b in zip(x, y))
+    x = x0
+  history = deque([x], maxlen=3)
+  error = tol + 1
+  iterations = 0
+  while error > tol:
+    iterations += 1
+    nxt = step(x)
+    error = change(x, nxt)
+    history.append(nxt)
+    if iterations % period == 0 and len(history) == 3:
+      if engine == 'numpy':
+        nxt = extrapolate_numpy(*history)
+        nxt *= total / nxt.sum()
+      else:
+        nxt = extrapolate_python(*history)
+        scale = total / sum(nxt)
+        nxt = [v * scale for v in nxt]
+      history.clear()
+      history.append(nxt)
+    x = nxt
+    trace(iterations, error)
+    if out_of_time(trace, budget, iterations):
+      break
+  return list(x), iterations
+
+def extrapolate_python(x0, x1, x2):
+  result = []
+  for a, b, c in zip(x0, x1, x2):
+    d = c - 2 * b + a
+    e = c - (c - b) ** 2 / d if abs(d) > 1e-12 else c
+    result.append(e if e > 0 else c)
+  return result
+
+def extrapolate_numpy(x0, x1, x2):
+  import numpy as np
+  d = x2 - 2 * x1 + x0
+  ok = np.abs(d) > 1e-12
+  e = x2.copy()
+  e[ok] = x2[ok] - (x2[ok] - x1[ok]) ** 2 / d[ok]
+  return np.where(e > 0, e, x2)
+
+# Starting from x0, which is close to the answer, push only the residual
+# r = Px - x: adding r[i] to x[i] moves r[i] along the arcs out of i. Only
+# nodes whose residual is above tol are touched, which are mostly those near
+# arcs that changed since x0 was computed. The work is reported in
+# iterations, one iteration being one pass over all arcs. The arcs out of a
+# node are found by bisection when the arcs are sorted by src, as those of
+# rank_users.py are. With numpy, the first residual is one bincount, and
+# once the pushes have done PUSH_LIMIT of an iteration the changes are not
+# local: a warm-started power_numpy, from where the pushes got, finishes.
+PUSH_LIMIT = 0.05
+
+def push(g, x0, tol, budget, trace, engine='python'):
+  n = g.n
+  m = len(g.src)
+  total = sum(x0)
+  if engine == 'numpy':
+    import numpy as np
+    src, dst, w = numpy_arcs(g)
+    x = np.array(x0, dtype=np.float64)
+    r = (np.bincount(dst, weights=x[src] * w, minlength=n) - x).tolist()
+    x = x.tolist()
+    ordered = bool(np.all(src[1:] >= src[:-1]))
+    limit = PUSH_LIMIT * m
+  else:
+    x = list(x0)
+    r = [-v for v in x]
+    for i, j, f in zip(g.src, g.dst, g.w):
+      r[j] += x[i] * f
+    ordered = all(a <= b for a, b in zip(g.src, islice(g.src, 1, None)))
+    limit = None
+  if ordered:
+    order = None
+  else:
+    start = [0] * (n + 1)
+    for i in g.src:
+      start[i + 1] += 1
+    for i in range(n):
+      start[i + 1] += start[i]
+    order = sorted(range(m), key=lambda k: g.src[k])
+  work = m
+  todo = deque(i for i in range(n) if abs(r[i]) > tol)
+  queued = [False] * n
+  for i in todo:
+    queued[i] = True
+  pushes = 0
+  while todo:
+    if limit is not None and work - m > limit:
+      scale = total / sum(x)
+      x, iterations = power_numpy(g, [v * scale for v in x], tol, budget,
+        trace)
+      return x, round(work / m + iterations, 1)
+    i = todo.popleft()
+    queued[i] = False
+    ri, r[i] = r[i], 0
+    x[i] += ri
+    if order is None:
+      lo = bisect_left(g.src, i)
+      arcs = range(lo, bisect_right(g.src, i, lo))
+    else:
+      arcs = order[start[i]:start[i + 1]]
+    for k in arcs:
+      j = g.dst[k]
+      r[j] += g.w[k] * ri
+      if not queued[j] and abs(r[j]) > tol:
+        queued[j] = True
+        todo.append(j)
+    work += len(arcs)
+    pushes += 1
+    if pushes % n == 0:
+      trace(round(work / m, 1), max(abs(v) for v in r))
+      if out_of_time(trace, budget, round(work / m, 1)):
+        break
+  # Pushes keep x a fixpoint up to the residual, but not its total.
+  scale = total / sum(x)
+  return [v * scale for v in x], round(work / m, 1)
+
+# Personalized pagerank by forward push, for arcs sorted by src: a walk starts
+# at a random seed and, at each step, either follows an arc or, with the
+# remaining probability, stops. An arc into `sink` counts as stopping. The
+# score of a node is the probability that the walk stops there. Residual
+# mass r[u] > tol is pushed from u, so the work is bounded by about
+# 1/(tol * stopping probability) pushes and depends only on the part of the
+# graph near the seeds. Returns (scores, pushes), with scores as a dict.
+def personalized(g, seeds, tol=1e-5, sink=None):
+  seeds = set(seeds)
+  p = {}
+  r = dict.fromkeys(seeds, 1 / len(seeds))
+  todo = deque(seeds)
+  queued = set(seeds)
+  pushes = 0
+  while todo:
+    u = todo.popleft()
+    queued.discard(u)
+    ru = r.pop(u, 0)
+    kept = ru
+    k = bisect_left(g.src, u)
+    while k < len(g.src) and g.src[k] == u:
+      v = g.dst[k]
+      if v != sink:
+        f = ru * g.w[k]
+        kept -= f
+        r[v] = r.get(v, 0) + f
+        if r[v] > tol and v not in queued:
+          queued.add(v)
+          todo.append(v)
+      k += 1
+    p[u] = p.get(u, 0) + kept
+    pushes += 1
+  return p, pushes
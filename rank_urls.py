@@ -1,14 +1,16 @@
 #!/usr/bin/env python3
 
 from argparse import ArgumentParser
+from array import array
 from collections import defaultdict
 
-import shelve
+import db
 import sys
 
 argparser = ArgumentParser(description='''
   Creates db/urlrank, by distributing user scores (db/userrank)
-  to the urls they mentioned (in db/slice).
+  to the urls they mentioned (in db/slice). The queries -e, -d, -w and -s
+  use indexes of the slice, which are rebuilt only when it changes.
 ''')
 
 argparser.add_argument('-n', '--toprint', default=10, type=int,
@@ -19,27 +21,56 @@ argparser.add_argument('-f', '--filter', default='twitter.com',
   help='do not include urls containing a certain substring')
 argparser.add_argument('-d', '--dump', action='store_true',
   help='for each user, all urls they mention')
+argparser.add_argument('-w', '--who', nargs='+', metavar='URL',
+  help='only report who mentioned these urls')
+argparser.add_argument('-s', '--shared-by', nargs='+', metavar='USER',
+  help='only report the urls these users mentioned')
+
+def dump(shared, filter):
+  for k, v in shared.items():
+    if k == db.INDEX_STAMP_KEY:
+      continue
+    name, ls = v
+    ls = [l for l in ls if l.find(filter) == -1]
+    if ls:
+      sys.stdout.write(name)
+      for l in ls:
+        sys.stdout.write(' {}'.format(l))
+      sys.stdout.write('\n')
+
+# Answers -w and -s from the indexes alone, without ranking.
+def query(args):
+  endorsers, shared = db.open_slice_indexes()
+  for l in args.who or ():
+    sys.stdout.write(l)
+    for name in endorsers.get(l, ()):
+      sys.stdout.write(' {}'.format(name))
+    sys.stdout.write('\n')
+  for name in args.shared_by or ():
+    name, ls = shared.get(name.lstrip('@').lower(), (name, ()))
+    sys.stdout.write(name)
+    for l in ls:
+      sys.stdout.write(' {}'.format(l))
+    sys.stdout.write('\n')
+  endorsers.close()
+  shared.close()
 
 def main():
   args = argparser.parse_args()
+  if args.who or args.shared_by:
+    query(args)
+    return
   urls_of_user = defaultdict(list)
-  with shelve.open('db/slice') as tweets:
-    for t in tweets.values():
-      for u in t.mention.urls:
-        if u.find(args.filter) == -1:
-          urls_of_user[t.author].append(u)
-  endorsers_of_url = defaultdict(set)
-  with shelve.open('db/users') as users:
+  with db.open_slice() as tweets:
+    for a, u in tweets.author_urls():
+      if u.find(args.filter) == -1:
+        urls_of_user[a].append(u)
+  endorsers_of_url = None
+  if args.dump or args.endorsers:
+    endorsers_of_url, shared = db.open_slice_indexes()
     if args.dump:
-      for u, ls in urls_of_user.items():
-        sys.stdout.write(users[u].screen_name)
-        for l in ls:
-          sys.stdout.write(' {}'.format(l))
-        sys.stdout.write('\n')
-    if args.endorsers:
-      for u, ls in urls_of_user.items():
-        for l in ls:
-          endorsers_of_url[l].add(users[u].screen_name)
+      dump(shared, args.filter)
+    shared.close()
   if False:
     url_counts = defaultdict(int)
     for ls in urls_of_user.values():
@@ -53,25 +84,56 @@ def main():
         user_counts[l] += 1
     for cnt, u in sorted((-cnt, u) for u, cnt in user_counts.items()):
       sys.stderr.write('freq {} {}\n'.format(-cnt, u))
-  score_of_url = defaultdict(float)
-  with shelve.open('db/userrank') as userrank:
-    def us(uid):
-      return userrank[uid] if uid in userrank else 0
-    for u, urls in urls_of_user.items():
-      if not urls:
-        continue
-      s = us(u) / len(urls)
-      for l in urls:
-        #sys.stderr.write('{:.2f} from {} to {}\n'.format(s,u,l))
-        score_of_url[l] += s
-  with shelve.open('db/urlrank', 'n') as urlrank:
-    for l, s in score_of_url.items():
-      urlrank[l] = s
+  # authors are numbered in order of appearance, for distribute()
+  index = {}
+  authors, urls = array('q'), []
+  for u, ls in urls_of_user.items():
+    for l in ls:
+      authors.append(index.setdefault(u, len(index)))
+      urls.append(l)
+  score = [0] * len(index)
+  with db.open_map('userrank') as userrank:
+    for u, i in index.items():
+      if str(u) in userrank:
+        score[i] = userrank[str(u)]
+  score_of_url = distribute(authors, urls, score)
+  save(score_of_url, args.toprint, endorsers_of_url)
+  if endorsers_of_url is not None:
+    endorsers_of_url.close()
+
+# Each author splits their score evenly among the urls they mentioned,
+# counting repeats. Returns the total score of each url. authors[k] is the
+# index in score of the author of the k-th mention of urls[k]. With numpy,
+# this is the sparse product of the score vector with the author-by-url
+# incidence matrix, done by two bincounts.
+def distribute(authors, urls, score):
+  index = {}
+  ui = array('q', (index.setdefault(l, len(index)) for l in urls))
+  try:
+    import numpy as np
+  except ImportError:
+    count = defaultdict(int)
+    for a in authors:
+      count[a] += 1
+    total = [0.0] * len(index)
+    for a, i in zip(authors, ui):
+      total[i] += score[a] / count[a]
+  else:
+    a = np.frombuffer(authors, dtype=np.int64)
+    count = np.bincount(a)
+    share = np.asarray(score, dtype=np.float64)[a] / count[a]
+    total = np.bincount(np.frombuffer(ui, dtype=np.int64), weights=share,
+      minlength=len(index)).tolist()
+  return dict(zip(index, total))
+
+def save(score_of_url, toprint, endorsers_of_url=None):
+  with db.open_map('urlrank', 'n') as urlrank:
+    urlrank.update(score_of_url)
   sys.stderr.write('ranked {} urls\n'.format(len(score_of_url)))
   xs = sorted((-s, l) for l, s in score_of_url.items())
-  for s, l in xs[:args.toprint]:
+  for s, l in xs[:toprint]:
     sys.stdout.write('{:9.6f} {}'.format(-s, l))
-    for u in sorted(endorsers_of_url[l]):
+    for u in (endorsers_of_url or {}).get(l, ()):
       sys.stdout.write(' {}'.format(u))
     sys.stdout.write('\n')
 
@@ -1,14 +1,23 @@
 #!/usr/bin/env python3
 
 from argparse import ArgumentParser
-from collections import defaultdict
+from array import array
+from time import perf_counter
 
-import shelve
+from pagerank import Graph, METHODS, have_numpy, personalized, solve
+
+import db
+import rank_urls
+import re
 import sys
 
 argparser = ArgumentParser(description='''
   Based on the tweets in db/slice, compute pagerank scores for users
-  and store them in db/userrank, overwriting any existing scores.
+  and store them in db/userrank, overwriting any existing scores. With -u,
+  also rank urls as rank_urls.py does, from the same read of the slice.
+  With -q,
+  instead report who matters around some users or hashtags, using
+  personalized pagerank; these answers are cached in db/pprcache.
 ''')
 
 argparser.add_argument('-n', '--toprint', default=10, type=int,
@@ -21,94 +30,334 @@ argparser.add_argument('-g', '--dumpgraph', action='store_true',
   help='dump graph arcs to stderr')
 argparser.add_argument('-r', '--dumpraw', action='store_true',
   help='dump graph arcs to stderr, adjacency lists')
+argparser.add_argument('-E', '--engine', default='numpy',
+  choices=['numpy', 'python'],
+  help='numpy is vectorized; python is the slow reference implementation')
+argparser.add_argument('-m', '--method', default='power',
+  choices=[m for m in METHODS if m != 'push'],
+  help='how to iterate; gauss-seidel and aitken usually need fewer iterations')
+argparser.add_argument('--budget', type=float,
+  help='stop iterating after this many seconds')
+argparser.add_argument('-j', '--workers', default=1, type=int,
+  help='processes for the numpy power method')
+argparser.add_argument('--trace',
+  help='append the residual of each iteration to this file, as TSV')
+argparser.add_argument('-c', '--check', action='store_true',
+  help='with -m power, run both engines, and check that they agree')
+argparser.add_argument('-w', '--warm', action='store_true',
+  help='start from the scores in db/userrank, instead of from scratch')
+argparser.add_argument('-d', '--delta', action='store_true',
+  help='like -w, but only push the changes through the graph (implies -w)')
+argparser.add_argument('-b', '--baseline', action='store_true',
+  help='with -w or -d, also run a cold start and report what was saved')
+argparser.add_argument('-u', '--urls', action='store_true',
+  help='also distribute the user scores to urls, into db/urlrank')
+argparser.add_argument('-f', '--filter', default='twitter.com',
+  help='with -u, do not include urls containing a certain substring')
+argparser.add_argument('-q', '--query', nargs='+', metavar='SEED',
+  help='seeds for personalized pagerank: @user or #hashtag')
+argparser.add_argument('-p', '--push-epsilon', default=1e-5, type=float,
+  help='residual left unpushed by -q; smaller is slower and more precise')
 args = None
 
 # compress user ids to integers 0, 1, ...
 los = [] # long_of_short
 sol = {} # short_of_long
 
+# for the hashtags of -q: short ids of the users who used them
+authors_of_tag = {}
+# for the users of -q: the short id of each lowercase screen name found
+user_of_name = {}
+
+# for -u: url_names[k] was mentioned by the user with short id url_authors[k]
+url_authors = array('q')
+url_names = []
+
 def register_userid(l):
-  if l in sol:
-    return
-  sol[l] = len(los)
-  los.append(l)
+  if l not in sol:
+    sol[l] = len(los)
+    los.append(l)
+  return sol[l]
+
+# The graph is a pagerank.Graph whose arcs are sorted by src. Node n - 1 is
+# the dummy node, which collects the taxation and the flow of users with no
+# mentions, and spreads it evenly.
 
 def dump_graph(g):
   global los, sol
-  n = len(g)
-  with shelve.open('db/users') as users:
+  n = g.n
+  with db.open_map('users') as users:
     def name(x):
       if x == n - 1:
         return 'DUMMY'
-      elif los[x] in users:
-        return users[los[x]].screen_name
+      elif str(los[x]) in users:
+        return users[str(los[x])].screen_name
       else:
         return 'unknown-{}'.format(los[x])
-    for s in range(n):
-      for t, w in g[s]:
-        sys.stderr.write('{:6.2f} {} {}\n'.format(w,name(s),name(t)))
+    for s, t, w in zip(g.src, g.dst, g.w):
+      sys.stderr.write('{:6.2f} {} {}\n'.format(w,name(s),name(t)))
+
+# Distinct arcs, with their counts, by sorting the packed keys; for when
+# there is no numpy.
+def count_arcs(src, dst, n):
+  keys = sorted(s * n + d for s, d in zip(src, dst))
+  asrc, adst, acnt = array('q'), array('q'), array('q')
+  last = None
+  for k in keys:
+    if k == last:
+      acnt[-1] += 1
+    else:
+      asrc.append(k // n)
+      adst.append(k % n)
+      acnt.append(1)
+      last = k
+  return asrc, adst, acnt
 
 def build_graph():
   global los, sol, args
-  with shelve.open('db/slice') as tweets:
-    for t in tweets.values():
-      register_userid(t.author)
-      for u in t.mention.users:
-        register_userid(u)
-  g = [defaultdict(int) for _ in range(len(los))]
-  with shelve.open('db/slice') as tweets:
+  # One pass over the slice: mentions go into flat arrays of arcs, which are
+  # then counted, with numpy if it is there.
+  src, dst = array('q'), array('q')
+  tags = {s[1:].lower() for s in args.query or () if s.startswith('#')}
+  for tag in tags:
+    authors_of_tag[tag] = set()
+  with db.open_slice() as tweets:
     for t in tweets.values():
+      a = register_userid(t.author)
+      if tags:
+        for tag in TAG_REGEX.findall(t.text):
+          if tag.lower() in tags:
+            authors_of_tag[tag.lower()].add(a)
+      if args.urls:
+        for l in t.mention.urls:
+          if l.find(args.filter) == -1:
+            url_authors.append(a)
+            url_names.append(l)
       for u in t.mention.users:
-        g[sol[t.author]][sol[u]] += 1
+        src.append(a)
+        dst.append(register_userid(u))
+  names = seed_names(args.query or ())
+  if names:
+    # Only the users of the slice can be seeds, so only they are looked up.
+    with db.open_map('users') as users:
+      for a, l in enumerate(los):
+        u = users.get(str(l))
+        if u is not None and u.screen_name.lower() in names:
+          user_of_name[u.screen_name.lower()] = a
+  n = len(los)
+  try:
+    import numpy as np
+  except ImportError:
+    np = None
+  if np is None:
+    asrc, adst, acnt = count_arcs(src, dst, n)
+  else:
+    # Packed keys, counted without turning them into Python ints.
+    keys = np.frombuffer(src, dtype=np.int64) * n + \
+      np.frombuffer(dst, dtype=np.int64)
+    del src, dst
+    keys, acnt = np.unique(keys, return_counts=True)
+    asrc, adst = keys // n, keys % n
+    del keys
+  m = len(asrc)
   if args.dumpraw:
-    sys.stderr.write('{}\n'.format(len(g)))
-    for d in g:
-      for k, v in d.items():
-        for _ in range(v):
-          sys.stderr.write('{} '.format(k + 1))
+    sys.stderr.write('{}\n'.format(n))
+    k = 0
+    for s in range(n):
+      while k < m and asrc[k] == s:
+        for _ in range(acnt[k]):
+          sys.stderr.write('{} '.format(adst[k] + 1))
+        k += 1
       sys.stderr.write('0\n')
-  for i in range(len(g)):
-    g[i][i] = 0
-  ng = []
-  dummy = len(g)
-  for oa in g:
-    z = sum(oa.values())
-    na = [(tgt, v/z*(1-args.alpha)) for tgt,v in oa.items() if v != 0]
-    na.append((dummy, 1-sum(v for _, v in na)))
-    ng.append(na)
-  na = [(i, 1/len(g)) for i in range(len(g))]
-  ng.append(na)
-  return ng
-
-def pagerank(g):
-  n = len(g)
-  nxt = [1]*n
-  now = None
-  error = args.epsilon + 1
-  iterations = 0
-  while error > args.epsilon:
-    iterations += 1
-    now, nxt = nxt, [0]*n
-    for i in range(n):
-      for j, f in g[i]:
-        nxt[j] += now[i] * f
-    error = max(abs(now[i]-nxt[i]) for i in range(n))
-  sys.stderr.write('used {} iterations for {} users\n'.format(iterations, n))
+  dummy = n
+  if np is None:
+    g = Graph(n + 1, array('q'), array('q'), array('d'))
+    k = 0
+    for s in range(n):
+      lo = k
+      while k < m and asrc[k] == s:
+        k += 1
+      out = [(adst[x], acnt[x]) for x in range(lo, k) if adst[x] != s]
+      z = sum(c for _, c in out)
+      total = 0
+      for d, c in out:
+        w = c/z*(1-args.alpha)
+        g.src.append(s)
+        g.dst.append(d)
+        g.w.append(w)
+        total += w
+      g.src.append(s)
+      g.dst.append(dummy)
+      g.w.append(1-total)
+  else:
+    # The same arcs and weights as above, in the same order, written in
+    # place: arc j goes to j + its source, after the arcs to the dummy node
+    # of the nodes before it. bincount adds in order, as the loop does.
+    keep = asrc != adst
+    asrc, adst, acnt = asrc[keep], adst[keep], acnt[keep]
+    m = len(asrc)
+    z = np.bincount(asrc, weights=acnt, minlength=n)
+    w = acnt / z[asrc] * (1-args.alpha)
+    total = np.bincount(asrc, weights=w, minlength=n)
+    size = m + 2*n
+    g = Graph(n + 1, array('q', [0]) * size, array('q', [0]) * size,
+      array('d', [0]) * size)
+    gsrc = np.frombuffer(g.src, dtype=np.int64)
+    gdst = np.frombuffer(g.dst, dtype=np.int64)
+    gw = np.frombuffer(g.w, dtype=np.float64)
+    nodes = np.arange(n, dtype=np.int64)
+    at = np.arange(m, dtype=np.int64) + asrc
+    gsrc[at], gdst[at], gw[at] = asrc, adst, w
+    at = np.cumsum(np.bincount(asrc, minlength=n)) + nodes
+    gsrc[at], gdst[at], gw[at] = nodes, dummy, 1 - total
+    gsrc[m+n:], gdst[m+n:], gw[m+n:] = dummy, nodes, 1/n
+    del gsrc, gdst, gw
+    return g
+  for i in range(n):
+    g.src.append(dummy)
+    g.dst.append(i)
+    g.w.append(1/n)
+  return g
+
+# Initial scores for a warm start: the stored score of each known user, and
+# the mean of those for new users. The dummy node gets whatever is needed to
+# keep the total flow at n, as in a cold start.
+def seed_scores(g):
+  n = g.n
+  x = [None] * n
+  with db.open_map('userrank') as userrank:
+    for i in range(n - 1):
+      k = str(los[i])
+      if k in userrank:
+        x[i] = userrank[k]
+  known = [v for v in x if v is not None]
+  mean = sum(known) / len(known) if known else 1
+  x = [mean if v is None else v for v in x]
+  x[n - 1] = max(0, n - sum(x[:n - 1]))
+  scale = n / sum(x)
+  sys.stderr.write('warm start: {} of {} users have stored scores\n'.format(
+    len(known), n - 1))
+  return [v * scale for v in x]
+
+def pagerank(g, x0=None):
+  n = g.n
+  method = 'push' if x0 and args.delta else args.method
+  engine = args.engine
+  if engine == 'numpy' and not have_numpy():
+    sys.stderr.write('W: no numpy; using the python engine\n')
+    engine = 'python'
+  def run(method, engine, x0):
+    return solve(g, method, engine, args.epsilon, args.budget, x0, args.trace,
+      args.workers if engine == 'numpy' else 1)
+  t = perf_counter()
+  now, iterations = run(method, engine, x0)
+  t = perf_counter() - t
+  sys.stderr.write('used {} iterations of {} for {} users\n'.format(
+    iterations, method, n))
   if not (0.99 * n < sum(now) < 1.01 * n):
     sys.stderr.write('W: numerical stability issues\n')
+  if x0 and args.baseline:
+    t0 = perf_counter()
+    _, cold_iterations = run(args.method, engine, None)
+    t0 = perf_counter() - t0
+    sys.stderr.write('cold start: {} iterations in {:.2f}s; warm start: {} '
+      'iterations in {:.2f}s ({:.0%} of the time saved)\n'.format(
+        cold_iterations, t0, iterations, t, 1 - t / t0 if t0 else 0))
+  if args.check and method == 'power':
+    other = run(method, 'numpy' if engine == 'python' else 'python', x0)
+    diff = max(abs(x - y) for x, y in zip(now, other[0]))
+    if other[1] != iterations or diff > 1e-9 * max(now):
+      sys.stderr.write('E: engines disagree: {} vs {} iterations, max diff {}\n'
+        .format(iterations, other[1], diff))
+      sys.exit(1)
+    sys.stderr.write('engines agree (max diff {:.2g})\n'.format(diff))
   return now
 
+TAG_REGEX = re.compile(r'#(\w+)')
+
+# Seeds are @screen_name (or just screen_name) and #hashtag.
+def seed_names(seeds):
+  return {s.lstrip('@').lower() for s in seeds if not s.startswith('#')}
+
+# Returns the short ids of the seed users, found by build_graph.
+def seed_users(seeds):
+  result = set()
+  for s in seeds:
+    if s.startswith('#'):
+      if not authors_of_tag[s[1:].lower()]:
+        sys.stderr.write('W: nobody used {} in the slice\n'.format(s))
+      result |= authors_of_tag[s[1:].lower()]
+  for name in sorted(seed_names(seeds)):
+    if name in user_of_name:
+      result.add(user_of_name[name])
+    else:
+      sys.stderr.write('W: @{} is unknown or has no tweets in the slice\n'
+        .format(name))
+  return result
+
+# Answers to -q are cached in db/pprcache under the stamp of the slice (see
+# db.touch_slice), the parameters and the seeds as given, so that a cached
+# answer is found without reading the slice. Entries of other stamps can no
+# longer be hit, and are dropped when a new answer is stored; at most
+# PPRCACHE_SIZE answers are kept for one stamp.
+PPRCACHE_SIZE = 1000
+
+def query_key(stamp):
+  seeds = sorted(set(s.lower() if s.startswith('#') else s.lstrip('@').lower()
+    for s in args.query))
+  return '{} {} {} {}'.format(stamp, args.alpha, args.push_epsilon,
+    ','.join(seeds))
+
+def cached_query():
+  with db.open_map('pprcache') as cache:
+    return cache.get(query_key(db.slice_stamp()))
+
+# Personalized pagerank around the seeds; returns the user ids of the seeds
+# and a list of (user id, score), with the best first.
+def query(g, seeds):
+  t = perf_counter()
+  p, pushes = personalized(g, seeds, args.push_epsilon, g.n - 1)
+  sys.stderr.write('{} pushes reached {} users in {:.2f}s\n'.format(
+    pushes, len(p), perf_counter() - t))
+  result = sorted(((los[i], x) for i, x in p.items()), key=lambda e: -e[1])
+  return sorted(los[s] for s in seeds), result
+
+def cache_query(stamp, answer):
+  prefix = stamp + ' '
+  with db.open_map('pprcache') as cache:
+    old = [k for k in cache if not k.startswith(prefix)]
+    if len(cache) - len(old) >= PPRCACHE_SIZE:
+      old = list(cache)
+    for k in old:
+      del cache[k]
+    cache[query_key(stamp)] = answer
+
+def report_query(answer, toprint):
+  seeds, result = answer
+  seeds = set(seeds)
+  with db.open_map('users') as users:
+    shown = 0
+    for i, x in result:
+      if shown == toprint:
+        break
+      if i in seeds:
+        continue
+      name = users[str(i)].screen_name if str(i) in users else \
+        'unknown-{}'.format(i)
+      sys.stdout.write('{:8.4f} https://twitter.com/{}\n'.format(x, name))
+      shown += 1
+
 def save(scores, toprint):
   n = len(scores) - 1
-  with shelve.open('db/userrank', 'n') as pr:
+  with db.open_map('userrank', 'n') as pr:
     for i in range(n):
-      pr[los[i]] = scores[i]
-  with shelve.open('db/users') as users:
+      pr[str(los[i])] = scores[i]
+  with db.open_map('users') as users:
     def sn(id):
-      if id not in users:
+      if str(id) not in users:
         return 'unknown-{}'.format(id)
       else:
-        return users[id].screen_name
+        return users[str(id)].screen_name
     xs = sorted((-scores[i], sn(los[i])) for i in range(n))
     sys.stderr.write('lost flow {:.1f}\n'.format(scores[n]))
     for s, un in xs[:toprint]:
@@ -118,11 +367,32 @@ def save(scores, toprint):
 def main():
   global args
   args = argparser.parse_args()
+  if args.query and not args.dumpgraph:
+    answer = cached_query()
+    if answer is not None:
+      sys.stderr.write('answer from cache\n')
+      report_query(answer, args.toprint)
+      return
+  # The stamp changes if the slice does while it is being read.
+  stamp = db.slice_stamp()
   g = build_graph()
   if args.dumpgraph:
     dump_graph(g)
-  scores = pagerank(g)
+  if args.query:
+    seeds = seed_users(args.query)
+    if not seeds:
+      sys.stderr.write('E: no seed users\n')
+      sys.exit(1)
+    answer = query(g, seeds)
+    cache_query(stamp, answer)
+    report_query(answer, args.toprint)
+    return
+  x0 = seed_scores(g) if args.warm or args.delta else None
+  scores = pagerank(g, x0)
   save(scores, args.toprint)
+  if args.urls:
+    rank_urls.save(rank_urls.distribute(url_authors, url_names, scores),
+      args.toprint)
 
 if __name__ == '__main__':
   main()
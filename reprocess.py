@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import archive
+import db
+import os
+import rollups
+import sys
+
+argparser = ArgumentParser(description='''
+  Rebuild db/tweets, db/users and db/rollups from the pages in db/archive,
+  without fetching anything. Segments are parsed in parallel, and written in
+  the order they were fetched, so that the latest copy of a tweet or user
+  wins.
+''')
+
+argparser.add_argument('-j', '--jobs', default=os.cpu_count(), type=int,
+  help='how many segments to parse at once')
+argparser.add_argument('-n', '--new', action='store_true',
+  help='start from empty db/tweets and db/users, instead of updating them')
+
+def parse_segment(segment):
+  users = {}
+  tweets = {}
+  for t in archive.read_segment(segment):
+    for i, name in db.users_of_status(t):
+      users[i] = name
+    tweets[t['id_str']] = db.tweet_of_status(t)
+  return users, tweets
+
+def main():
+  args = argparser.parse_args()
+  segments = archive.segments()
+  if not segments:
+    sys.stderr.write('E: nothing in {}\n'.format(archive.ARCHIVE_DIR))
+    sys.exit(1)
+  flag = 'n' if args.new else 'c'
+  screen_name = {}
+  written = 0
+  with db.open_tweets('tweets', flag) as tweets, \
+      db.open_map('rollups', flag) as buckets:
+    # At most jobs segments are parsed or waiting to be written at a time,
+    # so that parsed tweets do not pile up when writing is the slower part.
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+      todo = iter(segments)
+      running = deque((s, pool.submit(parse_segment, s))
+        for s in islice(todo, args.jobs))
+      while running:
+        segment, future = running.popleft()
+        users, parsed = future.result()
+        for s in islice(todo, 1):
+          running.append((s, pool.submit(parse_segment, s)))
+        screen_name.update(users)
+        tweets.update(parsed.items())
+        rollups.add(buckets, parsed.items())
+        written += len(parsed)
+        sys.stderr.write('{}: {} tweets, {} users\n'.format(
+          segment.name, len(parsed), len(users)))
+  with db.open_map('users', flag) as users:
+    users.update((i, db.User(name)) for i, name in screen_name.items()
+      if i not in users or users[i].screen_name != name)
+  db.touch_slice()
+  sys.stderr.write('wrote {} tweets and {} users from {} segments\n'.format(
+    written, len(screen_name), len(segments)))
+
+if __name__ == '__main__':
+  main()
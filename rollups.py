@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from collections import Counter
+from slice import parse_time, today
+
+import db
+import re
+import sys
+
+from words import Normalizer, WORD_REGEX
+
+argparser = ArgumentParser(description='''
+  Word, url, mention and author counts for a time range, added up from the
+  hourly rollups in db/rollups, without reading any tweets. fetch_tweets.py
+  and reprocess.py keep the rollups up to date as they add tweets; -r
+  rebuilds them from db/tweets, e.g. for a database older than them. The
+  range is widened to whole hours.
+''')
+
+argparser.add_argument('-r', '--rebuild', action='store_true',
+  help='first rebuild db/rollups from db/tweets')
+argparser.add_argument('-n', '--top', default=20, type=int,
+  help='how many of each to print')
+argparser.add_argument('-s', '--show', nargs='+',
+  default=['authors', 'mentions', 'words', 'urls'],
+  choices=['authors', 'mentions', 'words', 'urls'],
+  help='which counts to print')
+argparser.add_argument('starttime', nargs='?', type=parse_time,
+  help='e.g., 201704021130, or 201704 = 201704010000')
+argparser.add_argument('stoptime', nargs='?', type=parse_time,
+  help='e.g., 201704021130, or 201704 = 201704010000')
+
+# db/rollups maps the hour of the epoch, as a zero-padded decimal string, to
+# the db.Bucket of the tweets made in that hour. Users are ids; words are
+# normalized as in stats.py, leaving out mentions and links, and stopwords
+# are dropped when queried; urls are as fetched, and normalized when queried.
+HOUR = 60 * 60
+REBUILD_BATCH = 100000
+
+word_regex = re.compile(WORD_REGEX)
+link_regex = re.compile(r'https?://\S+')
+
+_normalizer = None
+def normalizer():
+  global _normalizer
+  if _normalizer is None:
+    _normalizer = Normalizer()
+  return _normalizer
+
+def words_of_text(text):
+  return [normalizer()(w) for w in word_regex.findall(link_regex.sub(' ', text))
+    if not w.startswith('@')]
+
+def key_of_hour(h):
+  return '{:010d}'.format(h)
+
+def add(rollups, tweets):
+  '''Counts (id, tweet) pairs into the rollups map; returns how many were
+  new. Each touched bucket is read and written once.'''
+  touched = {}
+  added = 0
+  for i, t in tweets:
+    k = key_of_hour(int(t.time // HOUR))
+    if k not in touched:
+      touched[k] = rollups.get(k) or db.Bucket()
+    added += touched[k].add(int(i), t, words_of_text(t.text))
+  rollups.update(touched)
+  return added
+
+def window(rollups, start, stop):
+  '''The counts of the hours that overlap [start, stop), as one Bucket.'''
+  total = db.Bucket()
+  for h in range(int(start // HOUR), -int(-stop // HOUR)):
+    b = rollups.get(key_of_hour(h))
+    if b is not None:
+      total.merge(b)
+  return total
+
+def normalize_urls(urls):
+  '''Maps urls through the cache of normalize_urls.py, merging counts.'''
+  from normalize_urls import canonicalize_url
+  result = Counter()
+  with db.open_map('urls') as cache:
+    for u, c in urls.items():
+      u = canonicalize_url(u)
+      entry = cache.get(u)
+      if isinstance(entry, str):
+        u = entry
+      elif entry is not None and entry[0] is not None:
+        u = entry[0]
+      result[u] += c
+  return result
+
+# The stopwords file of stats.py, if there is one here.
+def stopwords():
+  try:
+    with open('stopwords') as f:
+      return set(x.strip() for x in f)
+  except OSError:
+    return set()
+
+def rebuild():
+  with db.open_map('rollups', 'n') as rollups:
+    with db.open_tweets('tweets', 'r') as tweets:
+      batch = []
+      for it in tweets.items():
+        batch.append(it)
+        if len(batch) == REBUILD_BATCH:
+          add(rollups, batch)
+          batch = []
+      add(rollups, batch)
+
+def main():
+  args = argparser.parse_args()
+  if args.starttime is None:
+    args.starttime = today()
+  if args.stoptime is None:
+    args.stoptime = args.starttime + 60 * 60 * 24
+  if args.rebuild:
+    rebuild()
+  with db.open_map('rollups') as rollups:
+    total = window(rollups, args.starttime, args.stoptime)
+  sys.stdout.write('{} tweets\n'.format(total.count))
+  with db.open_map('users') as users:
+    def name(u):
+      u = str(u)
+      return users[u].screen_name if u in users else 'unknown-{}'.format(u)
+    for what in args.show:
+      sys.stdout.write('\n{}\n'.format(what))
+      counts = getattr(total, what)
+      if what == 'urls':
+        counts = normalize_urls(counts)
+      if what == 'words':
+        for w in stopwords():
+          counts.pop(w, None)
+      for x, c in counts.most_common(args.top):
+        if what == 'authors':
+          x = name(x)
+        elif what == 'mentions':
+          x = '{} -> {}'.format(name(x[0]), name(x[1]))
+        sys.stdout.write('{:9} {}\n'.format(c, x))
+
+if __name__ == '__main__':
+  main()
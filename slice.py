@@ -3,12 +3,13 @@
 from argparse import ArgumentParser
 from time import localtime, mktime, strftime, struct_time
 
-import shelve
-import shutil
+import db
 import sys
 
 argparser = ArgumentParser(description='''
-Extracts a time range from db/tweets and stores it in db/slice.
+Extracts a time range from db/tweets and stores it in db/slice. By default,
+db/slice is virtual: only the ids of the tweets in range are saved, in
+db/slice.ids, and the other scripts read them from db/tweets.
 ''')
 
 defaulttime = 'xxxx0101000000'
@@ -31,8 +32,10 @@ def parse_time(s):
 def today():
   return parse_time(strftime('%Y%02m%02d', localtime()))
 
+argparser.add_argument('-c', '--copy', action='store_true',
+  help='copy the tweets into a detached db/slice')
 argparser.add_argument('-o', action='store_true',
-  help='at the end, replace db/tweets by db/slice')
+  help='at the end, replace db/tweets by db/slice (implies -c)')
 argparser.add_argument('-v', '--verbose', action='store_true',
   help='say what it does')
 argparser.add_argument('starttime', nargs='?', type=parse_time,
@@ -46,20 +49,30 @@ def main():
     args.starttime = today()
   if args.stoptime is None:
     args.stoptime = args.starttime + 60 * 60 * 24
-  in_count = out_count = 0
-  with shelve.open('db/tweets') as tweets:
-    with shelve.open('db/slice','n') as slice:
-      for i, t in tweets.items():
-        in_count += 1
-        if not (args.starttime <= t.time < args.stoptime):
-          continue
-        out_count += 1
-        slice[i] = t
-  if args.verbose:
-    sys.stdout.write('kept {} out of {} tweets\n'.format(out_count, in_count))
   if args.o:
-    shutil.move('db/tweets', 'db/tweets.bck')
-    shutil.move('db/slice', 'db/tweets')
+    args.copy = True
+  with db.open_tweets('tweets') as tweets:
+    if args.copy:
+      db.remove_slice_manifest()
+      with db.open_tweets('slice','n') as slice:
+        kept = 0
+        def window():
+          nonlocal kept
+          for i, t in tweets.between(args.starttime, args.stoptime):
+            kept += 1
+            yield i, t
+        slice.update(window())
+    else:
+      ids = tweets.ids_between(args.starttime, args.stoptime)
+      db.write_slice_manifest(args.starttime, args.stoptime, ids)
+      db.open_tweets('slice','n').close()
+      kept = len(ids)
+    if args.verbose:
+      sys.stdout.write('kept {} out of {} tweets\n'.format(kept, len(tweets)))
+  db.touch_slice()
+  if args.o:
+    db.rename_tweets('tweets', 'tweets.bck')
+    db.rename_tweets('slice', 'tweets')
     if args.verbose:
       sys.stdout.write('old database saved in db/tweets.bck\n')
 
@@ -2,6 +2,7 @@
 # vim: set fileencoding=utf-8 :
 
 from calendar import timegm
+from collections import Counter
 from contextlib import closing
 from multiprocessing import cpu_count, Pool
 import re
@@ -11,6 +12,10 @@ from time import localtime, mktime, strftime, struct_time, time
 
 import requests
 
+import histograms
+import timeindex
+from words import Normalizer, WORD_REGEX
+
 #{{{ usage
 USAGE = """usage: ./stats.py [start_time [stop_time]]
 
@@ -25,10 +30,12 @@ The program creates two files.
   transcript.txt
     contains statuses in the specified range, one per line in the
     format 'AUTHOR: STATUS'
-  histograms
-    contains words and urls, with counts
+  histograms.d
+    contains words, urls and mentions of each user, with counts
 
 The program expects a database of Twitter statuses in ./statuses.
+On the first run, and after statuses are added, it also writes the
+time index statuses/timeidx and the copy statuses/records.
 """
 #}}}
 
@@ -48,10 +55,6 @@ def lst(s):
 def alt(l): 
   return '(' + '|'.join(['('+x+')' for x in l]) + ')'
 
-ROMNICE = u'ăîÎșşȘțţȚŢâÂăĂ'
-ROMUGLY = u'aiIssSttTTaAaA'
-ROMSIMPL = dict([(ROMNICE[i], ROMUGLY[i]) for i in range(len(ROMNICE))])
-WORD_REGEX = u'[@#]?[a-zA-Z0-9' + ROMNICE + u'_-]{3,}'
 # see RFC1738
 hex = '[0-9a-fA-F]'
 escape = '%' + hex + hex
@@ -94,14 +97,14 @@ def parse_time(s):
 #}}}
 
 #{{{ normalize functions
-def normalize_word(w):
-  def romsimpl(c):
-    if c not in ROMSIMPL:
-      return c
-    return ROMSIMPL[c]
-  wn = ''.join([romsimpl(c) for c in w]) 
-  wn = wn.lower()
-  return (w, wn)
+# Words are normalized in this process, through a cache that is kept in
+# statuses/words.lru between runs.
+word_normalizer = None
+def normalizer():
+  global word_normalizer
+  if word_normalizer is None:
+    word_normalizer = Normalizer('statuses/words.lru')
+  return word_normalizer
 
 def normalize_url(u):
   try:
@@ -111,11 +114,8 @@ def normalize_url(u):
   return (u, un)
 
 def normalize_all_words(l):
-  r = dict()
-  processes = Pool(max(1, cpu_count()-1))
-  for s in l.values():
-    for w, wn in processes.imap_unordered(normalize_word, s):
-      r[w] = wn
+  r = normalizer().all(w for s in l.values() for w in s)
+  normalizer().save()
   return r
 
 def normalize_all_urls(l):
@@ -148,7 +148,10 @@ def dummy_normalize(l):
   return r
 #}}}
 
-statuses_of_user = dict()
+# the users with statuses in the window, and where these are in
+# statuses/records: (offset, count) of each shard
+users = set()
+shard_bounds = []
 
 #{{{ extraction of features from statuses
 def match_and_bin(regex, normalize):
@@ -163,15 +166,12 @@ def match_and_bin(regex, normalize):
   histogram of normalized matches. It also returns a dictionary
   that gives, for each normalized match, its forms.'''
 
-  # for each user, list the matches, then normalize
-  pattern = re.compile(regex)
-  matches = dict()
-  for user, statuses in statuses_of_user.items():
-    user_matches = []
-    for s in statuses:
-      for m in re.finditer(pattern, s):
-        user_matches.append(m.group())
-    matches[user] = user_matches
+  # for each user, count the matches, then normalize the distinct ones
+  matches = dict((user, Counter()) for user in users)
+  with closing(Pool(cpu_count())) as processes:
+    for partial in processes.imap_unordered(count_matches, shards(regex)):
+      for user, counts in partial:
+        matches[user].update(counts)
   normalized = normalize(matches)
 
   # for each user, compute the histogram of normalized matches
@@ -179,20 +179,38 @@ def match_and_bin(regex, normalize):
   histo_of_user = dict()
   forms = dict()
   for user, user_matches in matches.items():
-    histo = dict()
-    for m in user_matches:
+    histo = Counter()
+    for m, count in user_matches.items():
       mn = normalized[m]
       if mn in STOPWORDS:
         continue
       if mn not in forms:
         forms[mn] = set()
       forms[mn].add(m)
-      if mn not in histo:
-        histo[mn] = 0
-      histo[mn] += 1
-    histo_of_user[user] = histo
+      histo[mn] += count
+    histo_of_user[user] = dict(histo)
   return (histo_of_user, forms)
 
+# Matching is done by a pool of processes, on shards of at most SHARD_SIZE
+# consecutive statuses of the window. Each process reads its own shard from
+# statuses/records, and only the counts come back, so at most a shard per
+# process is in memory.
+SHARD_SIZE = 10000
+
+def shards(regex):
+  for offset, count in shard_bounds:
+    yield regex, offset, count
+
+def count_matches(job):
+  regex, offset, count = job
+  pattern = re.compile(regex)
+  matches = dict()
+  for _, user, text in timeindex.read_records(offset, count):
+    if user not in matches:
+      matches[user] = Counter()
+    matches[user].update(m.group() for m in pattern.finditer(text))
+  return list(matches.items())
+
 def aggregate_histograms(histo_of_user, filter):
   histo = dict()
   for counts in histo_of_user.values():
@@ -226,21 +244,21 @@ def save_histograms(words_of_user, urls_of_user):
   all_users = set()
   all_users.update(words_of_user.keys())
   all_users.update(urls_of_user.keys())
-  with closing(shelve.open('histograms', 'n')) as f:
-    for u in all_users:
-      urls = get(urls_of_user, u)
-      old_words = get(words_of_user, u)
-      mentions = dict()
-      words = dict()
-      for w, cnt in old_words.items():
-        if w.startswith('@'):
-          wn = w[1:]
-          mentions[wn] = cnt
-        else:
-          words[w] = cnt
-      _, un = normalize_word(u)
-      data = {'urls' : dict(), 'words' : dict()}
-      f[un] = {'words' : words, 'urls' : urls, 'mentions' : mentions}
+  histograms_of_user = dict()
+  for u in all_users:
+    urls = get(urls_of_user, u)
+    old_words = get(words_of_user, u)
+    mentions = dict()
+    words = dict()
+    for w, cnt in old_words.items():
+      if w.startswith('@'):
+        wn = w[1:]
+        mentions[wn] = cnt
+      else:
+        words[w] = cnt
+    un = normalizer()(u)
+    histograms_of_user[un] = {'words' : words, 'urls' : urls, 'mentions' : mentions}
+  histograms.write(histograms_of_user)
 
 #{{{ cmd line parsing
 def parse_command_line():
@@ -265,40 +283,20 @@ def parse_command_line():
 
 def extract_and_bin():
   '''Go through the database and generate the file transcript.txt.
-  At the same time make a list, for each user, with its statuses.'''
-  global start_time
-  global stop_time
-  binstep = 0
-  with open('statuses/indexsize', 'r') as f:
-    size = int(f.readline())
-  with closing(shelve.open('statuses/data')) as db:
-    with closing(shelve.open('statuses/index')) as idx:
-      low, high = -1, size
-      while low + 1 < high:
-        binstep += 1
-        middle = (low + high) // 2
-        status_time = db[idx[str(middle)]]['time']
-        if status_time < start_time:
-          low = middle
-        else:
-          high = middle
-      print('  binstep',binstep)
-      low += 1
-      here('binsearch')
-      with open('transcript.txt', 'w') as transcript:
-        while low < size:
-          id = idx[str(low)]
-          status = db[id]
-          if status['time'] >= stop_time:
-            break
-          if status['user'] not in statuses_of_user:
-            statuses_of_user[status['user']] = []
-          statuses_of_user[status['user']].append(status['text'])
-          transcript.write('{} {}: {}\n'.format(
-            id,
-            status['user'],
-            status['text'].replace('\n', '   ')))
-          low += 1
+  At the same time note the users, and cut the window into shards.'''
+  timeindex.update()
+  here('time index')
+  with timeindex.TimeIndex() as index:
+    low, high = index.bounds(start_time, stop_time)
+    for k in range(low, high, SHARD_SIZE):
+      shard_bounds.append((index.offsets[k], min(SHARD_SIZE, high - k)))
+    with open('transcript.txt', 'w') as transcript:
+      for id, user, text in index.window(start_time, stop_time):
+        users.add(user)
+        transcript.write('{} {}: {}\n'.format(
+          id,
+          user,
+          text.replace('\n', '   ')))
 
 def main():
   parse_command_line()
@@ -2,15 +2,42 @@
 
 from argparse import ArgumentParser
 
+import db
+import json
+import sys
+
 argparser = ArgumentParser(description='''
-  Switch database.
+  Switch database. Copies everything in db/ to the new backend, and
+  records the choice in db/config.json.
 ''')
 
-argparser.add_argument('newdb', nargs='?',
-  help='name of new database')
+argparser.add_argument('newdb', nargs='?', choices=['sqlite', 'shelve'],
+  default='sqlite', help='name of new database')
 
 def main():
-  pass
+  args = argparser.parse_args()
+  old = db.backend()
+  if old == args.newdb:
+    sys.stderr.write('already using {}\n'.format(old))
+    return
+  for name in db.TWEET_TABLES:
+    with db.open_tweets(name, 'c', old) as src:
+      with db.open_tweets(name, 'n', args.newdb) as dst:
+        dst.update(src.items())
+        sys.stderr.write('copied {} tweets to {}\n'.format(len(dst), name))
+  for name in db.MAPS:
+    with db.open_map(name, 'c', old) as src:
+      with db.open_map(name, 'n', args.newdb) as dst:
+        dst.update(src.items())
+        sys.stderr.write('copied {} entries to {}\n'.format(len(dst), name))
+  configpath = db.DB_DIR / 'config.json'
+  config = {}
+  if configpath.exists():
+    with configpath.open() as f:
+      config = json.load(f)
+  config['backend'] = args.newdb
+  with configpath.open('w') as f:
+    json.dump(config, f, indent=2)
 
 if __name__ == '__main__':
   main()
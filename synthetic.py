@@ -0,0 +1,90 @@
+'''Synthetic statuses, shaped like those of the search API.
+
+Status k of a corpus is a function of k and the seed only, so that a page
+can be made without making the ones before it. Status 0 is the newest, and
+ids decrease with k, as in search results. Authors, mentioned users and urls
+are drawn log-uniformly, so a few of each are very popular; most urls are
+reused by many tweets.
+'''
+
+from time import gmtime, strftime
+
+import random
+
+ID_BASE = 10 ** 18
+
+WORDS = '''
+  acasă astăzi bucurești cluj concert cafea căldură centru ceață copii
+  drum dimineață echipa festival frumos guvern iași istorie liceu mâine
+  meci metrou ninsoare noapte oraș parc ploaie primărie prieteni românia
+  seară soare spital stradă știri școală teatru timișoara trafic țară
+  vacanță vreme weekend zăpadă
+'''.split()
+
+HASHTAGS = ['#bucuresti', '#romania', '#cluj', '#meci', '#vreme', '#trafic']
+
+def log_uniform(rng, n):
+  '''An integer in [0, n), with small values much more likely.'''
+  return min(n - 1, int((n + 1) ** rng.random()) - 1)
+
+class Corpus:
+  def __init__(self, size, users=None, urls=None, seed=0, start=1500000000,
+      interval=10, url_base='http://example.com'):
+    self.size = size
+    self.users = users or max(10, size // 20)
+    self.urls = urls or max(10, size // 50)
+    self.seed = seed
+    self.start = start
+    self.interval = interval
+    self.url_base = url_base
+
+  def oldest(self):
+    '''Time of the oldest status; the newest is at self.start.'''
+    return self.start - (self.size - 1) * self.interval
+
+  def id_of(self, k):
+    return ID_BASE + self.size - k
+
+  def index_of(self, i):
+    return ID_BASE + self.size - i
+
+  def user(self, u):
+    return {'id_str': str(u + 1), 'screen_name': 'user{}'.format(u + 1)}
+
+  def url(self, x):
+    return {'expanded_url': '{}/page/{}'.format(self.url_base, x)}
+
+  def status(self, k):
+    rng = random.Random(self.seed * 1000003 + k)
+    author = log_uniform(rng, self.users)
+    mentions = [log_uniform(rng, self.users)
+      for _ in range(log_uniform(rng, 4))]
+    urls = [log_uniform(rng, self.urls) for _ in range(log_uniform(rng, 3))]
+    words = [rng.choice(WORDS) for _ in range(rng.randint(3, 12))]
+    if rng.random() < 0.2:
+      words.append(rng.choice(HASHTAGS))
+    text = ' '.join(['@user{}'.format(m + 1) for m in mentions] + words +
+      [self.url(x)['expanded_url'] for x in urls])
+    reply = mentions[0] if mentions and rng.random() < 0.3 else None
+    return {
+      'id_str': str(self.id_of(k)),
+      'created_at': strftime('%a %b %d %H:%M:%S +0000 %Y',
+        gmtime(self.start - k * self.interval)),
+      'text': text,
+      'user': self.user(author),
+      'entities': {
+        'user_mentions': [self.user(m) for m in mentions],
+        'urls': [self.url(x) for x in urls]},
+      'in_reply_to_user_id_str':
+        None if reply is None else self.user(reply)['id_str'],
+      'in_reply_to_screen_name':
+        None if reply is None else self.user(reply)['screen_name'],
+    }
+
+  def __len__(self):
+    return self.size
+
+  def __getitem__(self, k):
+    if not 0 <= k < self.size:
+      raise IndexError(k)
+    return self.status(k)
@@ -0,0 +1,119 @@
+'''A time index over the legacy statuses/ database, for reading a window.
+
+statuses/records has the statuses pickled one after the other, as (id,
+user, text), in the order of statuses/index, which is oldest first.
+statuses/timeidx has a HEADER, then the time of each status as a double,
+then the offset of each status in statuses/records as an unsigned 64-bit
+integer, with one more offset for the end of the last one. Both columns
+are fixed width, so the index is mapped into memory and searched with
+bisect in place; a window of k statuses is then one seek and k sequential
+reads. update() appends the statuses that statuses/indexsize says were
+added since the last run, and rebuilds everything if there are fewer.
+'''
+
+from array import array
+from bisect import bisect_left
+from contextlib import closing
+from pathlib import Path
+
+import mmap
+import pickle
+import shelve
+import struct
+
+DIRECTORY = Path('statuses')
+HEADER = struct.Struct('<8sQ')
+MAGIC = b'TIMEIDX1'
+
+def indexed_size(directory=DIRECTORY):
+  with (directory / 'indexsize').open() as f:
+    return int(f.readline())
+
+def read_columns(directory=DIRECTORY):
+  '''The times and offsets in the index, as arrays; empty if it is missing
+  or does not match statuses/records.'''
+  times, offsets = array('d'), array('Q', [0])
+  try:
+    data = (directory / 'timeidx').read_bytes()
+    magic, count = HEADER.unpack_from(data)
+    records = (directory / 'records').stat().st_size
+  except (OSError, struct.error):
+    return times, offsets
+  body = data[HEADER.size:]
+  if magic != MAGIC or len(body) != 8 * count + 8 * (count + 1):
+    return times, offsets
+  times.frombytes(body[:8 * count])
+  offsets = array('Q', body[8 * count:])
+  if offsets[-1] > records:
+    return array('d'), array('Q', [0])
+  return times, offsets
+
+def update(directory=DIRECTORY):
+  '''Bring the index up to date with statuses/index; returns its size.'''
+  size = indexed_size(directory)
+  times, offsets = read_columns(directory)
+  if len(times) > size:
+    times, offsets = array('d'), array('Q', [0])
+  if len(times) == size:
+    return size
+  with (directory / 'records').open('r+b' if offsets[-1] else 'wb') as out:
+    # Drop whatever a run that stopped before writing the index appended.
+    out.truncate(offsets[-1])
+    out.seek(offsets[-1])
+    with closing(shelve.open(str(directory / 'data'), 'r')) as db:
+      with closing(shelve.open(str(directory / 'index'), 'r')) as idx:
+        for p in range(len(times), size):
+          id = idx[str(p)]
+          status = db[id]
+          pickle.dump((id, status['user'], status['text']), out,
+            pickle.HIGHEST_PROTOCOL)
+          times.append(status['time'])
+          offsets.append(out.tell())
+  tmp = directory / 'timeidx.tmp'
+  with tmp.open('wb') as f:
+    f.write(HEADER.pack(MAGIC, len(times)))
+    times.tofile(f)
+    offsets.tofile(f)
+  tmp.replace(directory / 'timeidx')
+  return size
+
+class TimeIndex:
+  def __init__(self, directory=DIRECTORY):
+    self.directory = directory
+    with (directory / 'timeidx').open('rb') as f:
+      self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _, self.count = HEADER.unpack_from(self.map)
+    end = HEADER.size + 8 * self.count
+    view = memoryview(self.map)
+    self.times = view[HEADER.size:end].cast('d')
+    self.offsets = view[end:].cast('Q')
+    view.release()
+
+  def __enter__(self):
+    return self
+  def __exit__(self, *exc):
+    self.close()
+
+  def close(self):
+    self.times.release()
+    self.offsets.release()
+    self.map.close()
+
+  def bounds(self, start, stop):
+    '''Positions low <= high of the statuses with start <= time < stop.'''
+    low = bisect_left(self.times, start)
+    return low, max(low, bisect_left(self.times, stop, low))
+
+  def window(self, start, stop):
+    '''(id, user, text) of the statuses with start <= time < stop.'''
+    low, high = self.bounds(start, stop)
+    return read_records(self.offsets[low], high - low, self.directory)
+
+def read_records(offset, count, directory=DIRECTORY):
+  '''count statuses of statuses/records, as (id, user, text), from offset.'''
+  if count == 0:
+    return
+  with (directory / 'records').open('rb') as f:
+    f.seek(offset)
+    for _ in range(count):
+      yield pickle.load(f)
@@ -0,0 +1,71 @@
+'''Normalization of words: diacritics are folded, then case.
+
+Folding is one str.translate, with a table built from FOLDINGS; to handle
+another language, add its pair of strings there. A Normalizer also keeps
+the most recently used words in a bounded cache, which can be saved and
+loaded, so that a run starts with the vocabulary of the previous one.
+'''
+
+from collections import OrderedDict
+from pathlib import Path
+
+import pickle
+
+# For each language, the letters to fold and what they fold to.
+FOLDINGS = {
+  'ro': (u'ăîÎșşȘțţȚŢâÂăĂ', u'aiIssSttTTaAaA'),
+}
+LANGUAGES = ['ro']
+
+ROMNICE = FOLDINGS['ro'][0]
+WORD_REGEX = u'[@#]?[a-zA-Z0-9' + ROMNICE + u'_-]{3,}'
+
+CACHE_SIZE = 1 << 20
+
+def fold_table(languages=LANGUAGES):
+  table = {}
+  for language in languages:
+    table.update(str.maketrans(*FOLDINGS[language]))
+  return table
+
+class Normalizer:
+  def __init__(self, path=None, capacity=CACHE_SIZE, languages=LANGUAGES):
+    self.table = fold_table(languages)
+    self.capacity = capacity
+    self.path = Path(path) if path else None
+    self.cache = OrderedDict()
+    self.dirty = False
+    if self.path and self.path.exists():
+      try:
+        with self.path.open('rb') as f:
+          self.cache.update(pickle.load(f))
+      except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+        self.cache.clear()
+
+  def fold(self, w):
+    return w.translate(self.table).lower()
+
+  def __call__(self, w):
+    try:
+      self.cache.move_to_end(w)
+      return self.cache[w]
+    except KeyError:
+      wn = self.fold(w)
+      self.cache[w] = wn
+      if len(self.cache) > self.capacity:
+        self.cache.popitem(last=False)
+      self.dirty = True
+      return wn
+
+  def all(self, words):
+    '''A dictionary from each of the distinct words to its normal form.'''
+    return dict((w, self(w)) for w in set(words))
+
+  def save(self):
+    if not self.path or not self.dirty:
+      return
+    tmp = self.path.with_name(self.path.name + '.tmp')
+    with tmp.open('wb') as f:
+      pickle.dump(list(self.cache.items()), f, pickle.HIGHEST_PROTOCOL)
+    tmp.replace(self.path)
+    self.dirty = False